@@ -1,9 +1,37 @@
-from datetime import datetime, timedelta
+import hashlib
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
 from jose import jwt, JWTError
 from passlib.context import CryptContext
+from cache import TTLCache
 from config import Config
+from metrics import PASSWORD_HASH_DURATION
+from token_revocation import create_revocation_list
+from workers import WorkerPool
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Pinning min and max to the configured work factor makes every hash made with another factor "need an update".
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=Config.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=Config.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=Config.BCRYPT_ROUNDS,
+)
+
+# bcrypt releases the GIL, so a few threads hash in parallel without blocking the event loop.
+password_hasher = WorkerPool(
+    "password-hasher",
+    Config.PASSWORD_HASH_WORKERS,
+    Config.PASSWORD_HASH_QUEUE_SIZE,
+    retry_after=Config.PASSWORD_HASH_RETRY_AFTER,
+    busy_detail="Too many logins at once, please retry",
+)
+
+def timed(func, *args):
+    with PASSWORD_HASH_DURATION.labels(func.__name__).time():
+        return func(*args)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -11,20 +39,32 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def hash_password(password: str) -> str:
+    return await password_hasher.run(timed, get_password_hash, password)
+
+async def check_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password; the second item is a new hash if the stored one uses an outdated work factor."""
+    return await password_hasher.run(timed, pwd_context.verify_and_update, plain_password, hashed_password)
+
+# Claims of tokens that passed verification, by token digest. Each entry expires with its token.
+token_cache = TTLCache(Config.TOKEN_CACHE_SIZE, Config.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+revocations = create_revocation_list()
+
+# jose reads naive datetimes as UTC, so expiry times must be aware ones.
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
-        expire = datetime.now() + expires_delta
+        expire = datetime.now(timezone.utc) + expires_delta
     else:
-        expire = datetime.now() + timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+        expire = datetime.now(timezone.utc) + timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire, "type": "access", "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, Config.SECRET_KEY, algorithm=Config.ALGORITHM)
     return encoded_jwt
 
 def create_refresh_token(data: dict):
-    expire = datetime.now() + timedelta(days=7)
+    expire = datetime.now(timezone.utc) + timedelta(days=7)
     to_encode = data.copy()
-    to_encode.update({"exp": expire, "type": "refresh"})
+    to_encode.update({"exp": expire, "type": "refresh", "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, Config.SECRET_KEY, algorithm=Config.ALGORITHM)
     return encoded_jwt
 
@@ -37,3 +77,30 @@ def decode_token(token: str):
         return payload  # Return the entire payload to obtain the token type and other data
     except JWTError:
         return None
+
+def token_id(token: str, payload: dict) -> str:
+    """The token's `jti`; tokens issued before they carried one are identified by their digest."""
+    return payload.get("jti") or hashlib.sha256(token.encode()).hexdigest()
+
+def verify_token(token: str) -> Optional[dict]:
+    """Claims of a valid, unexpired and unrevoked token, or None.
+
+    A token seen before is found by its digest in `token_cache`, which skips the signature check and
+    JSON decoding; expiry and revocation are still checked on every call.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = decode_token(token)
+        if payload is None or "exp" not in payload:
+            return None
+        token_cache.set(key, payload, ttl=payload["exp"] - time.time())
+    elif payload["exp"] <= time.time():
+        return None
+    if revocations.is_revoked(token_id(token, payload)):
+        return None
+    return payload
+
+async def revoke_token(token: str, payload: dict) -> bool:
+    """Refuse the token from now on. False if it was already revoked."""
+    return await revocations.revoke(token_id(token, payload), payload["exp"])
@@ -0,0 +1,135 @@
+import asyncio
+import mimetypes
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import Config
+from uploads import UploadedFile, remove_file, upload_quota
+import models
+
+
+class BlobStore:
+    """Teacher files stored once per content, as BLOB_DIR/ab/cd/<sha256>, behind a per-teacher name index.
+
+    `blobs.ref_count` counts the teacher_files rows pointing at a blob. Blobs nobody references for
+    BLOB_GC_GRACE seconds are deleted by `collect_garbage`. Uploads and the collector both lock the
+    blob's row before they look at its file, so a blob being collected is never reused.
+    """
+
+    def __init__(self, directory: str = Config.BLOB_DIR):
+        self.directory = directory
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256[2:4], sha256)
+
+    async def acquire(self, db: AsyncSession, sha256: str, size: int):
+        """Add a reference to a blob, creating its row if needed."""
+        while True:
+            result = await db.execute(
+                update(models.Blob)
+                .where(models.Blob.sha256 == sha256)
+                .values(ref_count=models.Blob.ref_count + 1)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount:
+                return
+            try:
+                async with db.begin_nested():
+                    await db.execute(insert(models.Blob).values(sha256=sha256, size=size, ref_count=1))
+                return
+            except IntegrityError:
+                # Created by a concurrent upload of the same content.
+                continue
+
+    async def release(self, db: AsyncSession, sha256: str):
+        await db.execute(
+            update(models.Blob)
+            .where(models.Blob.sha256 == sha256)
+            .values(ref_count=models.Blob.ref_count - 1, released_at=datetime.now())
+            .execution_options(synchronize_session=False)
+        )
+
+    async def add_file(self, db: AsyncSession, teacher_id: int, upload: UploadedFile):
+        """Point the teacher's `upload.filename` at the uploaded content and commit, keeping the content only if it is new.
+
+        The teacher's row is locked first, so two uploads of the same name wait for each other instead
+        of both inserting it. The rows are written before the content is moved into place, and content
+        this upload moved there is removed again if the commit fails.
+        """
+        await db.execute(select(models.User.id).where(models.User.id == teacher_id).with_for_update())
+        await self.acquire(db, upload.sha256, upload.size)
+        metadata = {
+            "blob_sha256": upload.sha256,
+            "size": upload.size,
+            "mime_type": mimetypes.guess_type(upload.filename)[0] or "application/octet-stream",
+            "uploaded_at": datetime.now(),
+        }
+        existing = await self.file(db, teacher_id, upload.filename, for_update=True)
+        if existing is None:
+            db.add(models.TeacherFile(teacher_id=teacher_id, name=upload.filename, **metadata))
+        else:
+            await self.release(db, existing.blob_sha256)
+            for field, value in metadata.items():
+                setattr(existing, field, value)
+        await db.flush()
+
+        path = self.path(upload.sha256)
+        if await asyncio.to_thread(os.path.isfile, path):
+            await upload.discard()
+            await db.commit()
+            return
+        await upload.move_to(path)
+        try:
+            await db.commit()
+        except BaseException:
+            await asyncio.to_thread(remove_file, path)
+            upload_quota.freed(upload.size)
+            raise
+
+    async def remove_file(self, db: AsyncSession, teacher_id: int, name: str) -> bool:
+        existing = await self.file(db, teacher_id, name, for_update=True)
+        if existing is None:
+            return False
+        await db.delete(existing)
+        await self.release(db, existing.blob_sha256)
+        return True
+
+    async def file(self, db: AsyncSession, teacher_id: int, name: str, for_update: bool = False) -> Optional[models.TeacherFile]:
+        query = select(models.TeacherFile).where(models.TeacherFile.teacher_id == teacher_id, models.TeacherFile.name == name)
+        if for_update:
+            query = query.with_for_update()
+        return (await db.scalars(query)).first()
+
+    async def stored_bytes(self, db: AsyncSession, teacher_id: int) -> int:
+        """What the teacher's files add up to, counting shared content in full."""
+        return await db.scalar(
+            select(func.coalesce(func.sum(models.TeacherFile.size), 0)).where(models.TeacherFile.teacher_id == teacher_id)
+        )
+
+    async def collect_garbage(self, db: AsyncSession) -> int:
+        """Delete up to BLOB_GC_BATCH unreferenced blobs. Returns how many were deleted."""
+        unreferenced = (
+            models.Blob.ref_count == 0,
+            models.Blob.released_at < datetime.now() - timedelta(seconds=Config.BLOB_GC_GRACE),
+        )
+        candidates = (await db.scalars(
+            select(models.Blob.sha256).where(*unreferenced).limit(Config.BLOB_GC_BATCH).with_for_update(skip_locked=True)
+        )).all()
+        if not candidates:
+            return 0
+        deleted = (await db.execute(
+            delete(models.Blob)
+            .where(models.Blob.sha256.in_(candidates), *unreferenced)
+            .returning(models.Blob.sha256, models.Blob.size)
+            .execution_options(synchronize_session=False)
+        )).all()
+        # Unlinked while the rows are still locked: an upload of the same content waits, then finds
+        # neither the row nor the file and stores its own copy.
+        for sha256, _ in deleted:
+            await asyncio.to_thread(remove_file, self.path(sha256))
+        await db.commit()
+        upload_quota.freed(sum(size for _, size in deleted))
+        return len(deleted)
@@ -0,0 +1,74 @@
+import sys
+from typing import Iterable, Optional
+
+FIELDS = ("id", "x", "y", "width", "height", "content", "contentType", "contentUrl", "pageNumber")
+INT_FIELDS = frozenset(("id", "x", "y", "width", "height", "pageNumber"))
+
+# The only fields each high-frequency action is allowed to change, and therefore to validate.
+ACTION_FIELDS = {
+    "move_block": ("x", "y"),
+    "resize_block": ("x", "y", "width", "height"),
+    "update_content": ("content", "contentType", "contentUrl"),
+    "update_page_number": ("pageNumber",),
+}
+
+
+def validate_field(field: str, value):
+    if field in INT_FIELDS:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str):
+            return int(value)
+        raise ValueError(f"{field} must be an integer")
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be a string")
+    return value
+
+
+def validate_fields(data: dict, fields: Iterable[str]) -> dict:
+    """Validated values for those of `fields` present in `data`; absent ones stay unchanged."""
+    return {field: validate_field(field, data[field]) for field in fields if field in data}
+
+
+class BoardBlock:
+    """A block as the board keeps it in memory.
+
+    Slotted instead of a pydantic model, with content types interned (a board only uses a handful)
+    and the serialized form cached until the block changes.
+    """
+
+    __slots__ = FIELDS + ("_dump",)
+
+    def __init__(self, id: int, x: int, y: int, width: int, height: int,
+                 content: str = "", contentType: str = "", contentUrl: str = "", pageNumber: int = 1):
+        self.id = id
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.content = content
+        self.contentType = sys.intern(contentType)
+        self.contentUrl = contentUrl
+        self.pageNumber = pageNumber
+        self._dump: Optional[dict] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BoardBlock":
+        """Build from already validated data, e.g. a patch recorded by the backend."""
+        return cls(**{field: data[field] for field in FIELDS if field in data})
+
+    def diff(self, changes: dict) -> dict:
+        return {field: value for field, value in changes.items() if getattr(self, field) != value}
+
+    def update(self, changes: dict):
+        for field, value in changes.items():
+            setattr(self, field, sys.intern(value) if field == "contentType" else value)
+        self._dump = None
+
+    def dump(self) -> dict:
+        """Serialized form, shared between callers: do not mutate it."""
+        if self._dump is None:
+            self._dump = {field: getattr(self, field) for field in FIELDS}
+        return self._dump
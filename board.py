@@ -0,0 +1,407 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from fastapi import WebSocket
+from pydantic_schemas import Block
+from blocks import ACTION_FIELDS, BoardBlock, validate_field, validate_fields
+from board_backends import BoardBackend
+from wire import Frame, Wire, negotiate
+from config import Config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT = "snapshot"
+
+# First and last page a connection sees; None means every page.
+Pages = Optional[Tuple[int, int]]
+
+
+def page_window(page: Optional[int], window: int = 0) -> Pages:
+    """The pages within `window` of `page`, or every page if no page is given."""
+    if page is None:
+        return None
+    window = max(window, 0)
+    return page - window, page + window
+
+
+class BoardMetrics:
+    def __init__(self):
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_coalesced = 0
+        self.resyncs = 0
+        self.evictions = 0
+        self.send_time_total = 0.0
+        self.send_time_max = 0.0
+
+    def record_send(self, elapsed: float, size: int):
+        self.messages_sent += 1
+        self.bytes_sent += size
+        self.send_time_total += elapsed
+        self.send_time_max = max(self.send_time_max, elapsed)
+
+
+class Connection:
+    """Outgoing side of one websocket: a bounded, coalescing queue drained by its own writer task."""
+
+    def __init__(self, board: "Board", websocket: WebSocket, wire: Wire, pages: Pages = None):
+        self.board = board
+        self.websocket = websocket
+        self.wire = wire
+        self.pages = pages
+        self.pending: "OrderedDict[object, Optional[Frame]]" = OrderedDict()
+        self.progress_at = time.monotonic()
+        self.sending = False
+        self.wakeup = asyncio.Event()
+        self.sequence = 0
+        self.task = asyncio.create_task(self._writer())
+
+    def sees(self, page: Optional[int]) -> bool:
+        return page is not None and (self.pages is None or self.pages[0] <= page <= self.pages[1])
+
+    @property
+    def lag(self) -> float:
+        """Seconds the writer has gone without delivering anything while messages are waiting."""
+        return time.monotonic() - self.progress_at if self.pending else 0.0
+
+    def enqueue(self, frame: Frame):
+        message = frame.message
+        if self.lag > Config.WS_MAX_LAG_SECONDS:
+            self.board.evict(self.websocket)
+            return
+        if SNAPSHOT in self.pending and message["type"] in ("patch_block", "delete_block"):
+            # The pending snapshot is built at send time and will already include this change.
+            return
+        if message["type"] in ("patch_block", "delete_block"):
+            key = ("block", message["id"])
+        else:
+            self.sequence += 1
+            key = self.sequence
+
+        previous = self.pending.pop(key, None)
+        if previous is not None:
+            self.board.metrics.messages_coalesced += 1
+            previous = previous.message
+            if previous["type"] == "patch_block" and message["type"] == "patch_block":
+                frame = Frame({**previous, "revision": message["revision"], "changes": {**previous["changes"], **message["changes"]}})
+        self._put(key, frame)
+
+        if len(self.pending) > Config.WS_SEND_QUEUE_SIZE:
+            self.resync()
+
+    def resync(self):
+        """Drop everything queued and send a fresh snapshot instead."""
+        self.board.metrics.resyncs += 1
+        self.pending.clear()
+        self._put(SNAPSHOT, None)
+
+    def _put(self, key, frame: Optional[Frame]):
+        if not self.pending and not self.sending:
+            self.progress_at = time.monotonic()
+        self.pending[key] = frame
+        self.wakeup.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.pending:
+                    key, frame = self.pending.popitem(last=False)
+                    if key == SNAPSHOT:
+                        frame = self.board.snapshot_frame(self.pages)
+                    started = time.monotonic()
+                    self.sending = True
+                    size = await self.wire.send(self.websocket, frame)
+                    self.sending = False
+                    self.progress_at = time.monotonic()
+                    self.board.metrics.record_send(self.progress_at - started, size)
+                    metrics.WS_MESSAGES_SENT.inc()
+                    metrics.WS_BYTES_SENT.inc(size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Error sending message: %s", e, extra={"board_id": self.board.board_id})
+            metrics.WS_CONNECTIONS_DROPPED.labels("send_error").inc()
+            self.board.disconnect(self.websocket)
+
+    async def receive(self) -> dict:
+        return await self.wire.receive(self.websocket)
+
+    def close(self):
+        self.task.cancel()
+        self.pending.clear()
+
+
+class Board:
+    def __init__(self, board_id: int, backend: BoardBackend):
+        self.board_id = board_id
+        self.backend = backend
+        self.connections: Dict[WebSocket, Connection] = {}
+        self.blocks: Dict[int, BoardBlock] = {}
+        # The same blocks by page number, so a connection's pages are found without a full scan.
+        self.pages: Dict[int, Dict[int, BoardBlock]] = {}
+        self.revision = 0
+        self.metrics = BoardMetrics()
+        self.lock = asyncio.Lock()
+        self.pending_updates: Dict[int, dict] = {}
+        self.update_lock = asyncio.Lock()
+        self.ticker: Optional[asyncio.Task] = None
+        self.cached_snapshots: Dict[Pages, Frame] = {}
+        self.cached_revision = 0
+
+    async def start(self):
+        """Subscribe to the board's updates, then load its current state from the backend."""
+        await self.backend.subscribe(self.board_id, self.receive)
+        async with self.lock:
+            await self.reload()
+
+    async def stop(self):
+        if self.ticker is not None:
+            self.ticker.cancel()
+        await self.flush_updates()
+        await self.backend.unsubscribe(self.board_id, self.receive)
+
+    async def reload(self):
+        self.revision, blocks = await self.backend.load(self.board_id)
+        self.blocks = {block_id: BoardBlock.from_dict(block) for block_id, block in blocks.items()}
+        self.pages = {}
+        for block in self.blocks.values():
+            self.index_block(block)
+        self.send_update_blocks()
+
+    def index_block(self, block: BoardBlock):
+        self.pages.setdefault(block.pageNumber, {})[block.id] = block
+
+    def unindex_block(self, block: BoardBlock):
+        page = self.pages.get(block.pageNumber)
+        if page is not None:
+            page.pop(block.id, None)
+            if not page:
+                del self.pages[block.pageNumber]
+
+    def blocks_on(self, pages: Pages) -> Iterable[BoardBlock]:
+        if pages is None:
+            return self.blocks.values()
+        first, last = pages
+        return [block for page, blocks in self.pages.items() if first <= page <= last for block in blocks.values()]
+
+    async def connect(self, websocket: WebSocket, since: Optional[int] = None, pages: Pages = None) -> Connection:
+        subprotocol, wire = negotiate(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = self.connections[websocket] = Connection(self, websocket, wire, pages)
+        if since is None:
+            self.send_snapshot(websocket)
+        else:
+            await self.send_changes_since(websocket, since)
+        return connection
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self.connections.pop(websocket, None)
+        if connection is not None:
+            connection.close()
+
+    def evict(self, websocket: WebSocket):
+        logger.warning("Evicting lagging connection", extra={"board_id": self.board_id, "client": str(websocket.client)})
+        self.metrics.evictions += 1
+        metrics.WS_CONNECTIONS_DROPPED.labels("lagging").inc()
+        self.disconnect(websocket)
+        asyncio.create_task(self._close(websocket))
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def snapshot(self, pages: Pages = None) -> dict:
+        snapshot = {
+            "type": "update_blocks",
+            "revision": self.revision,
+            "blocks": [block.dump() for block in self.blocks_on(pages)],
+        }
+        if pages is not None:
+            snapshot["pages"] = list(pages)
+        return snapshot
+
+    def snapshot_frame(self, pages: Pages = None) -> Frame:
+        # Every change bumps the revision, so a snapshot can be shared until the next one.
+        if self.cached_revision != self.revision:
+            self.cached_snapshots.clear()
+            self.cached_revision = self.revision
+        frame = self.cached_snapshots.get(pages)
+        if frame is None:
+            frame = self.cached_snapshots[pages] = Frame(self.snapshot(pages))
+        return frame
+
+    def send_snapshot(self, websocket: WebSocket):
+        self.connections[websocket].resync()
+
+    def subscribe(self, websocket: WebSocket, pages: Pages):
+        """Switch a connection to other pages; it gets a snapshot of them and from then on only their changes."""
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.pages = pages
+            connection.resync()
+
+    def send_page(self, websocket: WebSocket, page: int):
+        """Send one page's blocks on request, without subscribing to its changes."""
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(Frame({
+                "type": "page_blocks",
+                "revision": self.revision,
+                "page": page,
+                "blocks": [block.dump() for block in self.pages.get(page, {}).values()],
+            }))
+
+    async def send_changes_since(self, websocket: WebSocket, revision: int):
+        connection = self.connections.get(websocket)
+        if connection is not None and connection.pages is not None:
+            # The patch history is not kept by page; a snapshot of a few pages is small anyway.
+            self.send_snapshot(websocket)
+            return
+        patches = await self.backend.changes_since(self.board_id, revision)
+        if websocket not in self.connections:
+            return
+        if patches is None:
+            self.send_snapshot(websocket)
+        else:
+            revision = patches[-1]["revision"] if patches else revision
+            self.connections[websocket].enqueue(Frame({"type": "patches", "revision": revision, "patches": patches}))
+
+    def send_update_blocks(self):
+        for connection in list(self.connections.values()):
+            connection.resync()
+
+    def broadcast_patch(self, patch: dict, old_page: Optional[int], block: Optional[BoardBlock]):
+        """Send a block's patch to the connections that see its page, before or after the change."""
+        with metrics.WS_BROADCAST_DURATION.time():
+            frame = Frame(patch)
+            new_page = block.pageNumber if block is not None else None
+            full = None
+            for connection in list(self.connections.values()):
+                if connection.sees(old_page):
+                    connection.enqueue(frame)
+                elif connection.sees(new_page):
+                    # The block is new to this connection, which therefore needs all of it.
+                    if full is None:
+                        full = frame if old_page is None else Frame({**patch, "changes": block.dump()})
+                    connection.enqueue(full)
+
+    def stats(self) -> dict:
+        depths = [len(connection.pending) for connection in self.connections.values()]
+        metrics = self.metrics
+        return {
+            "connections": len(self.connections),
+            "revision": self.revision,
+            "blocks": len(self.blocks),
+            "pages": len(self.pages),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "lag_max": max((connection.lag for connection in self.connections.values()), default=0.0),
+            "messages_sent": metrics.messages_sent,
+            "bytes_sent": metrics.bytes_sent,
+            "messages_coalesced": metrics.messages_coalesced,
+            "resyncs": metrics.resyncs,
+            "evictions": metrics.evictions,
+            "send_latency_avg": metrics.send_time_total / metrics.messages_sent if metrics.messages_sent else 0.0,
+            "send_latency_max": metrics.send_time_max,
+        }
+
+    async def receive(self, patch: dict):
+        """Apply a patch recorded by the backend, possibly by another worker, and pass it on."""
+        async with self.lock:
+            if patch["type"] == "update_blocks":
+                await self.reload()
+                return
+            if patch["revision"] <= self.revision:
+                return
+            if patch["revision"] != self.revision + 1:
+                # Missed something on the way, start over from the backend's state.
+                await self.reload()
+                return
+
+            block = self.blocks.get(patch["id"])
+            old_page = block.pageNumber if block is not None else None
+            if patch["type"] == "delete_block":
+                if block is not None:
+                    del self.blocks[patch["id"]]
+                    self.unindex_block(block)
+                    block = None
+            elif block is not None:
+                moved = "pageNumber" in patch["changes"]
+                if moved:
+                    self.unindex_block(block)
+                block.update(patch["changes"])
+                if moved:
+                    self.index_block(block)
+            else:
+                block = self.blocks[patch["id"]] = BoardBlock.from_dict(patch["changes"])
+                self.index_block(block)
+            self.revision = patch["revision"]
+            self.broadcast_patch(patch, old_page, block)
+
+    def parse_block_update(self, action: str, data: dict):
+        """Validate only the fields `action` may change; new blocks are validated in full."""
+        block_id = validate_field("id", data["id"])
+        if action == "add_block" or block_id not in self.blocks:
+            return block_id, Block(**data).model_dump()
+        return block_id, validate_fields(data, ACTION_FIELDS[action])
+
+    async def schedule_block_update(self, action: str, data: dict):
+        """Queue a high-frequency update (move/resize); only the latest state per block goes out each tick."""
+        if not Config.BOARD_TICK_RATE:
+            await self.receive_block_update(action, data)
+            return
+        block_id, changes = self.parse_block_update(action, data)
+        self.pending_updates.setdefault(block_id, {}).update(changes)
+        if self.ticker is None or self.ticker.done():
+            self.ticker = asyncio.create_task(self._tick())
+
+    async def _tick(self):
+        interval = 1 / Config.BOARD_TICK_RATE
+        while self.pending_updates:
+            await asyncio.sleep(interval)
+            await self.flush_updates()
+
+    async def flush_updates(self):
+        async with self.update_lock:
+            await self._flush_updates()
+
+    async def _flush_updates(self):
+        pending, self.pending_updates = self.pending_updates, {}
+        for block_id, changes in pending.items():
+            await self._apply_block_update(block_id, changes)
+
+    async def receive_block_update(self, action: str, data: dict):
+        block_id, changes = self.parse_block_update(action, data)
+        # Discrete actions go out right away, after whatever moves are still pending, to keep the order.
+        async with self.update_lock:
+            await self._flush_updates()
+            await self._apply_block_update(block_id, changes)
+
+    async def _apply_block_update(self, block_id: int, changes: dict):
+        current = self.blocks.get(block_id)
+        if current is None:
+            if len(changes) < len(Block.model_fields):
+                # Partial update for a block deleted in the meantime.
+                return
+            block = changes
+        else:
+            changes = current.diff(changes)
+            if not changes:
+                return
+            block = {**current.dump(), **changes}
+        await self.backend.apply(self.board_id, {"type": "patch_block", "id": block_id, "changes": changes, "block": block})
+
+    async def delete_block(self, block_id: int):
+        async with self.update_lock:
+            self.pending_updates.pop(block_id, None)
+            await self._flush_updates()
+            # The local copy may lag behind other workers, so the backend decides whether the block exists.
+            await self.backend.apply(self.board_id, {"type": "delete_block", "id": block_id})
@@ -0,0 +1,276 @@
+import json
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+import redis.asyncio as redis
+from board_store import BoardStore
+from config import Config
+from redis_pubsub import RedisSubscriber
+
+logger = logging.getLogger(__name__)
+
+Subscriber = Callable[[dict], Awaitable[None]]
+
+
+def patches_since(history, current_revision: int, revision: int) -> Optional[List[dict]]:
+    """Patches after `revision`, or None if the history no longer covers it."""
+    if revision == current_revision:
+        return []
+    if revision > current_revision or not history or history[0]["revision"] > revision + 1:
+        return None
+    return [patch for patch in history if patch["revision"] > revision]
+
+
+class BoardBackend:
+    """Where board state lives and how recorded changes reach every worker serving a board.
+
+    `apply` takes a `patch_block` (with the full `block` alongside its `changes`) or a
+    `delete_block` operation, assigns it the next board revision, stores it and publishes
+    the recorded patch to all subscribers of the board, including the caller's own worker.
+    `replace` swaps out the whole board and publishes `{"type": "update_blocks"}` so that
+    subscribers reload it.
+    """
+
+    async def load(self, board_id: int) -> Tuple[int, Dict[int, dict]]:
+        raise NotImplementedError
+
+    async def apply(self, board_id: int, operation: dict) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def replace(self, board_id: int, blocks: List[dict]) -> int:
+        raise NotImplementedError
+
+    async def changes_since(self, board_id: int, revision: int) -> Optional[List[dict]]:
+        raise NotImplementedError
+
+    async def subscribe(self, board_id: int, subscriber: Subscriber):
+        raise NotImplementedError
+
+    async def unsubscribe(self, board_id: int, subscriber: Subscriber):
+        raise NotImplementedError
+
+    async def unload(self, board_id: int):
+        """Let go of whatever this process holds for a board nobody here is using; `load` brings it back."""
+
+    async def close(self):
+        pass
+
+
+class BoardState:
+    def __init__(self):
+        self.revision = 0
+        self.blocks: Dict[int, dict] = {}
+        self.history: Deque[dict] = deque(maxlen=Config.BOARD_HISTORY_SIZE)
+
+
+class MemoryBoardBackend(BoardBackend):
+    """Keeps every board in this process. Only correct with a single worker.
+
+    With a `BoardStore` every recorded patch is also appended to the board's log on disk, and
+    boards this process has not seen yet are restored from there, e.g. after a restart.
+    """
+
+    def __init__(self, store: Optional[BoardStore] = None):
+        self.store = store
+        self.states: Dict[int, BoardState] = {}
+        self.subscribers: Dict[int, List[Subscriber]] = {}
+
+    async def state(self, board_id: int) -> BoardState:
+        if board_id not in self.states:
+            restored = await self.store.load(board_id) if self.store else None
+            if board_id not in self.states:
+                state = self.states[board_id] = BoardState()
+                if restored:
+                    state.revision, state.blocks = restored
+        return self.states[board_id]
+
+    async def load(self, board_id: int) -> Tuple[int, Dict[int, dict]]:
+        state = self.states.get(board_id)
+        if state is None:
+            # Reading a board does not keep it in memory; only a change or a subscriber does.
+            restored = await self.store.load(board_id) if self.store else None
+            state = self.states.get(board_id)
+            if state is None:
+                return restored if restored else (0, {})
+        return state.revision, dict(state.blocks)
+
+    async def apply(self, board_id: int, operation: dict) -> Optional[dict]:
+        state = await self.state(board_id)
+        block_id = operation["id"]
+        if operation["type"] == "delete_block":
+            if state.blocks.pop(block_id, None) is None:
+                return None
+            patch = {"type": "delete_block", "id": block_id}
+        else:
+            current = state.blocks.get(block_id)
+            if current is None:
+                state.blocks[block_id] = dict(operation["block"])
+                changes = operation["block"]
+            else:
+                state.blocks[block_id] = {**current, **operation["changes"]}
+                changes = operation["changes"]
+            patch = {"type": "patch_block", "id": block_id, "changes": changes}
+
+        state.revision += 1
+        patch["revision"] = state.revision
+        state.history.append(patch)
+        if self.store:
+            self.store.append(board_id, patch)
+        await self.publish(board_id, patch)
+        return patch
+
+    async def replace(self, board_id: int, blocks: List[dict]) -> int:
+        state = await self.state(board_id)
+        state.blocks = {block["id"]: dict(block) for block in blocks}
+        state.revision += 1
+        state.history.clear()
+        if self.store:
+            await self.store.snapshot(board_id, state.revision, state.blocks)
+        await self.publish(board_id, {"type": "update_blocks", "revision": state.revision})
+        return state.revision
+
+    async def changes_since(self, board_id: int, revision: int) -> Optional[List[dict]]:
+        state = await self.state(board_id)
+        return patches_since(state.history, state.revision, revision)
+
+    async def subscribe(self, board_id: int, subscriber: Subscriber):
+        self.subscribers.setdefault(board_id, []).append(subscriber)
+
+    async def unsubscribe(self, board_id: int, subscriber: Subscriber):
+        subscribers = self.subscribers.get(board_id, [])
+        if subscriber in subscribers:
+            subscribers.remove(subscriber)
+        if not subscribers:
+            self.subscribers.pop(board_id, None)
+
+    async def publish(self, board_id: int, message: dict):
+        for subscriber in list(self.subscribers.get(board_id, [])):
+            await subscriber(message)
+
+    async def unload(self, board_id: int):
+        """Snapshot the board to the store, if it changed since the last one, and drop it from memory.
+
+        Without a store the board is the only copy and stays.
+        """
+        state = self.states.get(board_id)
+        if state is None or self.store is None or board_id in self.subscribers:
+            return
+        if self.store.appended.get(board_id):
+            await self.store.snapshot(board_id, state.revision, state.blocks)
+        # Patches applied during the snapshot are in the log, which the next `state` replays.
+        if board_id not in self.subscribers:
+            self.states.pop(board_id, None)
+
+
+# KEYS: revision, blocks, history, channel. ARGV: operation json, history size.
+# Runs atomically, so revisions are published in the order they are assigned.
+APPLY_SCRIPT = """
+local operation = cjson.decode(ARGV[1])
+local block_id = tostring(operation.id)
+local patch = {type = operation.type, id = operation.id}
+if operation.type == 'delete_block' then
+    if redis.call('HDEL', KEYS[2], block_id) == 0 then
+        return false
+    end
+else
+    local current = redis.call('HGET', KEYS[2], block_id)
+    local block = operation.block
+    if current then
+        block = cjson.decode(current)
+        for key, value in pairs(operation.changes) do
+            block[key] = value
+        end
+        patch.changes = operation.changes
+    else
+        patch.changes = operation.block
+    end
+    redis.call('HSET', KEYS[2], block_id, cjson.encode(block))
+end
+patch.revision = redis.call('INCR', KEYS[1])
+local encoded = cjson.encode(patch)
+redis.call('RPUSH', KEYS[3], encoded)
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[2]), -1)
+redis.call('PUBLISH', KEYS[4], encoded)
+return encoded
+"""
+
+
+class RedisBoardBackend(BoardBackend):
+    """Boards kept in Redis, so any worker can serve any board and boards outlive the workers.
+
+    Each board has a revision counter, a hash of its blocks and a capped patch history. Patches are
+    recorded by a Lua script and published on the board's channel, to which every worker serving
+    the board subscribes.
+    """
+
+    def __init__(self, url: str = Config.REDIS_URL, client: Optional[redis.Redis] = None):
+        self.client = client if client is not None else redis.from_url(url)
+        self.apply_script = self.client.register_script(APPLY_SCRIPT)
+        self.subscriber = RedisSubscriber(self.client, self.receive, "Board")
+        self.subscribers: Dict[int, List[Subscriber]] = {}
+
+    @staticmethod
+    def keys(board_id: int) -> List[str]:
+        # The hash tag keeps all keys of one board in the same cluster slot.
+        prefix = f"board:{{{board_id}}}"
+        return [f"{prefix}:revision", f"{prefix}:blocks", f"{prefix}:history", prefix]
+
+    async def load(self, board_id: int) -> Tuple[int, Dict[int, dict]]:
+        revision_key, blocks_key, _, _ = self.keys(board_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            revision, blocks = await pipe.get(revision_key).hgetall(blocks_key).execute()
+        return int(revision or 0), {int(block_id): json.loads(block) for block_id, block in blocks.items()}
+
+    async def apply(self, board_id: int, operation: dict) -> Optional[dict]:
+        patch = await self.apply_script(keys=self.keys(board_id), args=[json.dumps(operation), Config.BOARD_HISTORY_SIZE])
+        return json.loads(patch) if patch else None
+
+    async def replace(self, board_id: int, blocks: List[dict]) -> int:
+        revision_key, blocks_key, history_key, channel = self.keys(board_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(blocks_key, history_key)
+            if blocks:
+                pipe.hset(blocks_key, mapping={str(block["id"]): json.dumps(block) for block in blocks})
+            pipe.incr(revision_key)
+            pipe.publish(channel, json.dumps({"type": "update_blocks"}))
+            results = await pipe.execute()
+        return int(results[-2])
+
+    async def changes_since(self, board_id: int, revision: int) -> Optional[List[dict]]:
+        revision_key, _, history_key, _ = self.keys(board_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            current, history = await pipe.get(revision_key).lrange(history_key, 0, -1).execute()
+        return patches_since([json.loads(patch) for patch in history], int(current or 0), revision)
+
+    async def subscribe(self, board_id: int, subscriber: Subscriber):
+        if board_id not in self.subscribers:
+            self.subscribers[board_id] = []
+            await self.subscriber.subscribe(self.keys(board_id)[3])
+        self.subscribers[board_id].append(subscriber)
+
+    async def unsubscribe(self, board_id: int, subscriber: Subscriber):
+        subscribers = self.subscribers.get(board_id, [])
+        if subscriber in subscribers:
+            subscribers.remove(subscriber)
+        if not subscribers and board_id in self.subscribers:
+            del self.subscribers[board_id]
+            await self.subscriber.unsubscribe(self.keys(board_id)[3])
+
+    async def receive(self, channel: bytes, data: bytes):
+        board_id = int(channel.decode().split("{")[1].split("}")[0])
+        patch = json.loads(data)
+        for subscriber in list(self.subscribers.get(board_id, [])):
+            try:
+                await subscriber(patch)
+            except Exception:
+                logger.exception("Error handling board update", extra={"board_id": board_id})
+
+    async def close(self):
+        await self.subscriber.close()
+        await self.client.aclose()
+
+
+def create_board_backend(store: Optional[BoardStore] = None) -> BoardBackend:
+    if Config.BOARD_BACKEND == "redis":
+        return RedisBoardBackend()
+    return MemoryBoardBackend(store)
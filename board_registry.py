@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+from board import Board
+from board_backends import BoardBackend
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class BoardRegistry:
+    """The boards this worker holds in memory, each with the number of websockets using it.
+
+    A board nobody has used for BOARD_IDLE_TIMEOUT seconds is written to the store and dropped. So
+    are the least recently used idle boards whenever all boards together hold more than
+    BOARD_MAX_BLOCKS blocks. A dropped board is loaded back from the store on the next connect.
+    """
+
+    def __init__(self, backend: BoardBackend):
+        self.backend = backend
+        self.boards: Dict[int, Board] = {}
+        self.refs: Dict[int, int] = {}
+        # Boards without connections, least recently used first.
+        self.idle_since: Dict[int, float] = {}
+        # Boards being loaded. Everyone acquiring such a board waits for the same task and its outcome.
+        self.starting: Dict[int, asyncio.Task] = {}
+        self.unloading: Dict[int, asyncio.Task] = {}
+        self.sweeper: Optional[asyncio.Task] = None
+        self.evictions = 0
+        self.spills = 0
+
+    def get(self, board_id: int) -> Optional[Board]:
+        return self.boards.get(board_id)
+
+    async def acquire(self, board_id: int) -> Board:
+        """The board, loaded if needed. It stays in memory at least until the matching `release`."""
+        self.refs[board_id] = self.refs.get(board_id, 0) + 1
+        self.idle_since.pop(board_id, None)
+        try:
+            while board_id in self.unloading:
+                await asyncio.shield(self.unloading[board_id])
+            board = self.boards.get(board_id)
+            if board is None:
+                board = self.boards[board_id] = Board(board_id, self.backend)
+                self.starting[board_id] = asyncio.create_task(self._start(board_id, board))
+            starting = self.starting.get(board_id)
+            if starting is not None:
+                # Shielded: one caller going away must not cancel the load for the others.
+                await asyncio.shield(starting)
+        except BaseException:
+            self.release(board_id)
+            raise
+        self.spill()
+        return board
+
+    async def _start(self, board_id: int, board: Board):
+        try:
+            await board.start()
+        except BaseException:
+            if self.boards.get(board_id) is board:
+                del self.boards[board_id]
+            raise
+        finally:
+            if self.starting.get(board_id) is asyncio.current_task():
+                del self.starting[board_id]
+
+    def release(self, board_id: int):
+        refs = self.refs.pop(board_id, 0) - 1
+        if refs > 0:
+            self.refs[board_id] = refs
+        elif board_id in self.boards:
+            self.idle_since[board_id] = time.monotonic()
+            self.spill()
+
+    async def unload_idle(self, board_id: int):
+        """Drop the board now unless someone is connected, e.g. once its lesson has been saved."""
+        if not self.refs.get(board_id):
+            await self.start_unload(board_id)
+
+    def start_unload(self, board_id: int) -> asyncio.Task:
+        board = self.boards.pop(board_id, None)
+        self.idle_since.pop(board_id, None)
+        previous = self.unloading.get(board_id)
+        task = self.unloading[board_id] = asyncio.create_task(self._unload(board_id, board, previous))
+        return task
+
+    async def _unload(self, board_id: int, board: Optional[Board], previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await previous
+            if board is not None:
+                await board.stop()
+            await self.backend.unload(board_id)
+        except Exception:
+            logger.exception("Error unloading board", extra={"board_id": board_id})
+        finally:
+            if self.unloading.get(board_id) is asyncio.current_task():
+                del self.unloading[board_id]
+
+    def spill(self):
+        """Unload idle boards, least recently used first, until the blocks in memory are within BOARD_MAX_BLOCKS."""
+        total = sum(len(board.blocks) for board in self.boards.values())
+        for board_id in list(self.idle_since):
+            if total <= Config.BOARD_MAX_BLOCKS:
+                break
+            total -= len(self.boards[board_id].blocks)
+            self.spills += 1
+            self.start_unload(board_id)
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(Config.BOARD_IDLE_SWEEP_INTERVAL)
+            cutoff = time.monotonic() - Config.BOARD_IDLE_TIMEOUT
+            for board_id, since in list(self.idle_since.items()):
+                if since > cutoff:
+                    break
+                self.evictions += 1
+                self.start_unload(board_id)
+            self.spill()
+
+    def start(self):
+        self.sweeper = asyncio.create_task(self.sweep_forever())
+
+    async def close(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        for board in self.boards.values():
+            await board.stop()
+        if self.unloading:
+            await asyncio.wait(list(self.unloading.values()))
+
+    def stats(self) -> dict:
+        return {
+            "boards": len(self.boards),
+            "idle_boards": len(self.idle_since),
+            "connections": sum(self.refs.values()),
+            "blocks": sum(len(board.blocks) for board in self.boards.values()),
+            "evictions": self.evictions,
+            "spills": self.spills,
+        }
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+StoredBoard = Tuple[int, Dict[int, dict]]
+
+
+def apply_patch(blocks: Dict[int, dict], patch: dict):
+    if patch["type"] == "delete_block":
+        blocks.pop(patch["id"], None)
+    else:
+        blocks[patch["id"]] = {**blocks.get(patch["id"], {}), **patch["changes"]}
+
+
+class BoardStore:
+    """Durable board state on disk: an append-only patch log per board plus its latest snapshot.
+
+    All file I/O happens on a single writer task that hands the blocking work to a thread, so
+    appends, snapshots and log compaction for a board are applied in the order they were requested.
+    """
+
+    def __init__(self, directory: str = Config.BOARD_SAVE_DIR):
+        self.directory = directory
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.writer: Optional[asyncio.Task] = None
+        self.compactor: Optional[asyncio.Task] = None
+        self.appended: Dict[int, int] = {}
+        self.checked_logs = set()
+
+    def log_path(self, board_id: int) -> str:
+        return os.path.join(self.directory, f"{board_id}.log")
+
+    def snapshot_path(self, board_id: int) -> str:
+        return os.path.join(self.directory, f"{board_id}.snapshot.json")
+
+    def append(self, board_id: int, patch: dict):
+        self.appended[board_id] = self.appended.get(board_id, 0) + 1
+        self._submit(("append", board_id, json.dumps(patch)))
+
+    async def snapshot(self, board_id: int, revision: int, blocks: Dict[int, dict]):
+        """Write a snapshot and drop the log entries it covers. Returns once it is on disk."""
+        self.appended.pop(board_id, None)
+        done = asyncio.get_running_loop().create_future()
+        self._submit(("snapshot", board_id, (revision, list(blocks.values())), done))
+        await done
+
+    async def flush(self):
+        done = asyncio.get_running_loop().create_future()
+        self._submit(("flush", None, None, done))
+        await done
+
+    async def load(self, board_id: int) -> Optional[StoredBoard]:
+        """The board as of everything appended so far, including appends still queued."""
+        if self.writer is not None and not self.writer.done():
+            await self.flush()
+        return await asyncio.to_thread(self._load, board_id)
+
+    def start_compaction(self, source: Callable[[int], Awaitable[StoredBoard]]):
+        self.compactor = asyncio.create_task(self._compact_forever(source))
+
+    async def close(self):
+        if self.compactor is not None:
+            self.compactor.cancel()
+        if self.writer is not None:
+            await self.flush()
+            self.writer.cancel()
+
+    def _submit(self, item: tuple):
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self._write_forever())
+        self.queue.put_nowait(item)
+
+    async def _write_forever(self):
+        while True:
+            item = await self.queue.get()
+            appends: Dict[int, List[str]] = {}
+            # Batch up everything already queued into one trip to the thread pool.
+            while item is not None and item[0] == "append":
+                appends.setdefault(item[1], []).append(item[2])
+                item = self.queue.get_nowait() if not self.queue.empty() else None
+            try:
+                if appends:
+                    await asyncio.to_thread(self._write_appends, appends)
+                if item is not None and item[0] == "snapshot":
+                    await asyncio.to_thread(self._write_snapshot, item[1], *item[2])
+            except Exception as e:
+                logger.exception("Error writing board state")
+                if item is not None and not item[3].done():
+                    item[3].set_exception(e)
+            if item is not None and not item[3].done():
+                item[3].set_result(None)
+
+    async def _compact_forever(self, source: Callable[[int], Awaitable[StoredBoard]]):
+        while True:
+            await asyncio.sleep(Config.BOARD_COMPACT_INTERVAL)
+            for board_id, appended in list(self.appended.items()):
+                if appended < Config.BOARD_COMPACT_MIN_PATCHES:
+                    continue
+                try:
+                    revision, blocks = await source(board_id)
+                    await self.snapshot(board_id, revision, blocks)
+                except Exception:
+                    logger.exception("Error compacting board", extra={"board_id": board_id})
+
+    def _write_appends(self, appends: Dict[int, List[str]]):
+        os.makedirs(self.directory, exist_ok=True)
+        for board_id, lines in appends.items():
+            with open(self.log_path(board_id), "a+") as log:
+                if board_id not in self.checked_logs:
+                    # Start on a fresh line in case the previous process died mid-write.
+                    if log.tell() > 0:
+                        log.seek(log.tell() - 1)
+                        if log.read(1) != "\n":
+                            log.write("\n")
+                    self.checked_logs.add(board_id)
+                log.write("\n".join(lines) + "\n")
+                log.flush()
+                if Config.BOARD_LOG_FSYNC:
+                    os.fsync(log.fileno())
+
+    def _write_snapshot(self, board_id: int, revision: int, blocks: List[dict]):
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_path = self.snapshot_path(board_id)
+        with open(snapshot_path + ".tmp", "w") as snapshot:
+            json.dump({"revision": revision, "blocks": blocks}, snapshot)
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+
+        # Keep only the tail of the log that the snapshot does not cover yet.
+        tail = [line for line in self._read_log(board_id) if json.loads(line)["revision"] > revision]
+        log_path = self.log_path(board_id)
+        with open(log_path + ".tmp", "w") as log:
+            log.write("".join(line + "\n" for line in tail))
+        os.replace(log_path + ".tmp", log_path)
+
+    def _read_log(self, board_id: int) -> List[str]:
+        if not os.path.isfile(self.log_path(board_id)):
+            return []
+        lines = []
+        with open(self.log_path(board_id)) as log:
+            for line in log:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    json.loads(line)
+                except ValueError:
+                    # Torn write from a crash.
+                    continue
+                lines.append(line)
+        return lines
+
+    def _load(self, board_id: int) -> Optional[StoredBoard]:
+        revision, blocks, found = 0, {}, False
+        if os.path.isfile(self.snapshot_path(board_id)):
+            with open(self.snapshot_path(board_id)) as snapshot:
+                state = json.load(snapshot)
+            revision, blocks, found = state["revision"], {block["id"]: block for block in state["blocks"]}, True
+        for line in self._read_log(board_id):
+            patch = json.loads(line)
+            if patch["revision"] > revision:
+                apply_patch(blocks, patch)
+                revision, found = patch["revision"], True
+        return (revision, blocks) if found else None
@@ -6,13 +6,97 @@ class Config:
     database_name = 'school'
 
     SQLALCHEMY_DATABASE_URI = f'{db_type}://{username}:{password}@{host}/{database_name}'
+    ASYNC_SQLALCHEMY_DATABASE_URI = f'{db_type}+asyncpg://{username}:{password}@{host}/{database_name}'
+    DB_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 20
+    DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+    DB_POOL_RECYCLE = 1800  # seconds before a connection is replaced
+
+    # Test mode runs against a local SQLite file and creates the tables on startup.
+    TESTING = False
+    TEST_DATABASE_URI = 'sqlite:///./test.db'
+    TEST_ASYNC_DATABASE_URI = 'sqlite+aiosqlite:///./test.db'
 
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = "your_secret_key_here"  #TODO Generate a strong secret key
     ALGORITHM = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES = 90
+    TOKEN_CACHE_SIZE = 10000  # verified tokens kept in memory per worker, each until it expires
+    TOKEN_REVOCATION_BACKEND = "memory"  # "redis" shares logouts and used refresh tokens between workers (uses REDIS_URL)
+    TOKEN_REVOCATION_PURGE_INTERVAL = 60  # seconds between dropping revocations of tokens that have expired anyway
 
     IMAGE_UPLOAD_DIR = "uploaded/img"
-    FILES_UPLOAD_DIR = "uploaded/teachers"
+    FILES_UPLOAD_DIR = "uploaded/teachers"  # per-teacher copies from before BLOB_DIR, see scripts/migrate_files_to_blobs.py
     BOARD_SAVE_DIR = "uploaded/boards"
+    BLOB_DIR = "uploaded/blobs"  # teacher files, one per content, named by SHA-256
+    PHOTO_VARIANT_DIR = "uploaded/img/variants"  # resized profile photos, see PHOTO_SIZES
+    UPLOAD_TMP_DIR = "uploaded/tmp"  # uploads in progress; keep it on the same filesystem as the directories above
+
+    BOARD_HISTORY_SIZE = 1000  # patches kept per board for "changes since revision" resyncs
+    WS_SEND_QUEUE_SIZE = 256  # pending messages per connection before it is forced to resync
+    WS_MAX_LAG_SECONDS = 10  # connections backlogged for longer than this are evicted
+
+    BOARD_BACKEND = "memory"  # "memory" for a single worker, "redis" to share boards between workers and hosts
+    REDIS_URL = "redis://localhost:6379/0"
+    BOARD_TICK_RATE = 30  # Hz at which move/resize updates are flushed; 0 sends each one immediately
+
+    BOARD_COMPACT_INTERVAL = 60  # seconds between compaction passes over the board logs
+    BOARD_COMPACT_MIN_PATCHES = 500  # patches appended since the last snapshot before a board is compacted
+    BOARD_LOG_FSYNC = False  # fsync the patch log after every batch of appends
+    BOARD_IDLE_TIMEOUT = 600  # seconds without connections before a board is written out and dropped from memory
+    BOARD_IDLE_SWEEP_INTERVAL = 60  # seconds between checks for idle boards
+    BOARD_MAX_BLOCKS = 200000  # blocks held in memory across all boards before idle ones are dropped, oldest first
+
+    BCRYPT_ROUNDS = 12  # work factor; stored hashes are upgraded on the next login when it changes
+    PASSWORD_HASH_WORKERS = 4  # threads running bcrypt
+    PASSWORD_HASH_QUEUE_SIZE = 64  # hashing jobs allowed to wait for a thread before answering 503
+    PASSWORD_HASH_RETRY_AFTER = 2  # seconds, sent in Retry-After with the 503
+
+    USER_CACHE_SIZE = 10000  # authenticated users kept in memory per worker
+    USER_CACHE_TTL = 60  # seconds; bounds how stale a profile changed on another worker can be
+
+    TEACHERS_CACHE_TTL = 30  # seconds the serialized /teachers response is reused
+    LESSON_COUNTERS_RECONCILE_INTERVAL = 3600  # seconds between recounts of users.lessons_amount
+
+    LESSONS_PAGE_SIZE = 100  # default page size of the lesson listings
+    LESSONS_MAX_PAGE_SIZE = 1000
+    LESSONS_STREAM_BATCH = 500  # rows fetched per round trip when streaming NDJSON
+    FILES_PAGE_SIZE = 100  # default page size of /my-files
+    FILES_MAX_PAGE_SIZE = 1000
+    LESSON_MAX_DURATION = 480  # minutes; also bounds how far back the scheduling overlap check looks
+    LESSONS_BULK_MAX = 5000  # lessons accepted by one /lessons/bulk request after expanding rules
+
+    UPLOAD_MAX_SIZE = 1024 * 1024 * 1024  # bytes per file sent to /upload
+    PHOTO_MAX_SIZE = 10 * 1024 * 1024  # bytes per profile photo
+    USER_FILES_QUOTA = 10 * 1024 * 1024 * 1024  # bytes of lesson files per user
+    UPLOADS_TOTAL_QUOTA = 500 * 1024 * 1024 * 1024  # bytes of all uploaded files and photos together
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes buffered before each write to disk
+    UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart framing allowed on top of the file size
+    BLOB_GC_INTERVAL = 600  # seconds between sweeps for unreferenced teacher files
+    BLOB_GC_GRACE = 3600  # seconds an unreferenced file is kept before it is deleted
+    BLOB_GC_BATCH = 500  # files deleted per transaction
+
+    FILE_CACHE_CONTROL = "private, no-cache"  # teacher files can be replaced under the same name, so revalidate
+    PHOTO_CACHE_CONTROL = "public, max-age=31536000, immutable"  # uploaded photos are never changed in place
+    FILE_STAT_CACHE_SIZE = 10000  # os.stat results kept in memory
+    FILE_STAT_CACHE_TTL = 60  # seconds
+    FILE_CHUNK_SIZE = 256 * 1024  # bytes read per step when sending a byte range
+    FILE_SENDFILE = None  # "X-Accel-Redirect" (nginx) or "X-Sendfile" (Apache, lighttpd) to let the proxy send files
+    FILE_ACCEL_REDIRECT_ROOT = "uploaded"  # directory exposed by the internal nginx location below
+    FILE_ACCEL_REDIRECT_PREFIX = "/protected/"
+
+    PHOTO_SIZES = (64, 256, 1024)  # longest side in pixels of the resized profile photos, ascending
+    PHOTO_VARIANT_QUALITY = 80  # WebP/JPEG quality of the resized photos
+    PHOTO_ORIGINAL_QUALITY = 95  # JPEG quality when an original is rewritten without its metadata
+    PHOTO_MAX_PIXELS = 50_000_000  # larger images are rejected rather than decoded
+    PHOTO_WORKERS = 2  # threads running Pillow
+    PHOTO_QUEUE_SIZE = 32  # photo jobs allowed to wait for a thread before answering 503
+    PHOTO_RETRY_AFTER = 2  # seconds, sent in Retry-After with the 503
+
+    LOG_LEVEL = "INFO"
+    LOG_FORMAT = "json"  # "json" for one object per line, "text" for reading in a terminal
+    PROFILER_ENABLED = False  # expose POST /debug/profile, which samples the event loop's stack
+    PROFILER_INTERVAL = 0.005  # seconds between samples
+    PROFILER_MAX_SECONDS = 60  # longest profile one request may take
+    PROFILER_USERS = ()  # logins allowed to call /debug/profile; nobody else can, even with it enabled
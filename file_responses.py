@@ -0,0 +1,151 @@
+import asyncio
+import mimetypes
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+from fastapi import Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from cache import TTLCache
+from config import Config
+
+# os.stat results by path. Only files that exist are cached, so a fresh upload is served at once.
+stat_cache = TTLCache(Config.FILE_STAT_CACHE_SIZE, Config.FILE_STAT_CACHE_TTL)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+async def stat_file(path: str) -> Optional[os.stat_result]:
+    result = stat_cache.get(path)
+    if result is None:
+        try:
+            result = await asyncio.to_thread(os.stat, path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(result.st_mode):
+            return None
+        stat_cache.set(path, result)
+    return result
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single `bytes=` range. None means the header is ignored and the whole file is sent."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header lists `etag` (weak comparison) or is `*`."""
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def range_applies(request: Request, etag: str, last_modified: str) -> bool:
+    """If-Range: only honour Range when the client's copy is still current."""
+    if_range = request.headers.get("if-range")
+    return if_range is None or if_range.strip() in (etag, last_modified)
+
+
+async def read_range(path: str, first: int, length: int):
+    file = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(file.seek, first)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(Config.FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+def sendfile_location(path: str) -> str:
+    if Config.FILE_SENDFILE == "X-Accel-Redirect":
+        relative = os.path.relpath(path, Config.FILE_ACCEL_REDIRECT_ROOT).replace(os.sep, "/")
+        return Config.FILE_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + relative
+    return os.path.abspath(path)
+
+
+async def serve_file(request: Request, path: str, media_type: Optional[str] = None, etag: Optional[str] = None,
+                     cache_control: str = Config.FILE_CACHE_CONTROL) -> Optional[Response]:
+    """Send a file with validators, 304s and single byte ranges. None if there is no such file.
+
+    `etag` defaults to one derived from the file's size and modification time; pass a content hash
+    when there is one. With FILE_SENDFILE set, the body is left to the front proxy.
+    """
+    stat_result = await stat_file(path)
+    if stat_result is None:
+        return None
+    if etag is None:
+        etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if media_type is None:
+        media_type = mimetypes.guess_type(path)[0] or "text/plain"
+
+    if not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if Config.FILE_SENDFILE:
+        # The proxy serves the body and answers Range requests itself.
+        headers[Config.FILE_SENDFILE] = sendfile_location(path)
+        return Response(headers=headers, media_type=media_type)
+
+    size = stat_result.st_size
+    range_header = request.headers.get("range")
+    if range_header and range_applies(request, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+        if byte_range is not None:
+            first, last = byte_range
+            headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+            headers["Content-Length"] = str(last - first + 1)
+            return StreamingResponse(
+                read_range(path, first, last - first + 1),
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                headers=headers,
+                media_type=media_type,
+            )
+
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
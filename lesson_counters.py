@@ -0,0 +1,50 @@
+from collections import Counter
+from typing import Iterable
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic_schemas import LessonCreate
+import models
+
+COMPLETED_STATUS = 3
+
+
+async def track_status_change(db: AsyncSession, teacher_id: int, old_status: int, new_status: int) -> int:
+    """Adjust the teacher's `lessons_amount` in the current transaction. Returns the change applied."""
+    delta = (new_status == COMPLETED_STATUS) - (old_status == COMPLETED_STATUS)
+    if delta and teacher_id is not None:
+        await db.execute(
+            update(models.User)
+            .where(models.User.id == teacher_id)
+            .values(lessons_amount=models.User.lessons_amount + delta)
+            .execution_options(synchronize_session=False)
+        )
+    return delta
+
+
+async def track_new_lessons(db: AsyncSession, lessons: Iterable[LessonCreate]) -> bool:
+    """Count the completed ones among freshly inserted lessons. Returns whether any counter changed."""
+    completed = Counter(lesson.teacher_id for lesson in lessons if lesson.status_id == COMPLETED_STATUS)
+    for teacher_id, amount in completed.items():
+        await db.execute(
+            update(models.User)
+            .where(models.User.id == teacher_id)
+            .values(lessons_amount=models.User.lessons_amount + amount)
+            .execution_options(synchronize_session=False)
+        )
+    return bool(completed)
+
+
+async def reconcile(db: AsyncSession) -> int:
+    """Recount completed lessons for every user whose counter drifted. Returns the number of users fixed."""
+    completed = select(func.count(models.Class.id)).where(
+        models.Class.teacher_id == models.User.id,
+        models.Class.status_id == COMPLETED_STATUS,
+    ).scalar_subquery()
+    result = await db.execute(
+        update(models.User)
+        .where(models.User.lessons_amount != completed)
+        .values(lessons_amount=completed)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
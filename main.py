@@ -1,79 +1,250 @@
+import asyncio
+import base64
+import hashlib
 import json
+import logging
 import os
 import uuid
-from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Dict, List
-from fastapi import FastAPI, Form, HTTPException, Depends, WebSocket, WebSocketDisconnect, status, File, UploadFile
-from fastapi.responses import FileResponse, JSONResponse
+from typing import Dict, List, Optional
+from fastapi import FastAPI, Form, HTTPException, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic_schemas import LessonUpdateStatus, UserCreate, Token, RefreshTokenRequest, UserLogIn, UserProfile, Block, Teacher, LessonCreate, Lesson
-from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy import func, or_, select
-from jose import JWTError
+from pydantic_schemas import LessonUpdateStatus, UserCreate, Token, RefreshTokenRequest, UserLogIn, UserProfile, Block, Teacher, LessonCreate, Lesson, LessonBatch, LessonTime, TeacherFiles
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from pydantic import TypeAdapter
+from sqlalchemy import or_, select, tuple_
+from sqlalchemy.orm import joinedload
+from board import Board, Pages, page_window
+from board_backends import create_board_backend
+from blob_store import BlobStore
+from board_registry import BoardRegistry
+from board_store import BoardStore
+from cache import TTLCache
 from config import Config
 import models
 import auth
+import file_responses
+import lesson_counters
+import logs
+import metrics
+import photos
+import profiler
+import scheduling
+import uploads
+import workers
+
+logs.configure_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-class Board:
-    def __init__(self):
-        self.connections: List[WebSocket] = []
-        self.blocks: Dict[int, Block] = {}
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.connections.append(websocket)
-        await self.send_update_blocks()
-
-    def disconnect(self, websocket: WebSocket):
-        self.connections.remove(websocket)
-
-    async def send_update_blocks(self):
-        data = {"type": "update_blocks", "blocks": [block.model_dump() for block in self.blocks.values()]}
-        await self.broadcast(data)
-
-    async def broadcast(self, message: dict):
-        disconnected_connections = []
-        for connection in self.connections:
-            try:
-                await connection.send_json(message)
-            except RuntimeError as e:
-                print(f"Error sending message: {e}")
-                disconnected_connections.append(connection)
-
-        for connection in disconnected_connections:
-            self.disconnect(connection)
-
-    async def receive_block_update(self, block: Block):
-        self.blocks[block.id] = block
-        await self.send_update_blocks()
-
-    async def delete_block(self, block_id: int):
-        if block_id in self.blocks:
-            del self.blocks[block_id]
-            await self.send_update_blocks()
-
-boards: Dict[int, Board] = {}
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=models.engine)
-def get_db():
-    db = SessionLocal()
-    try:
+@app.exception_handler(workers.WorkerPoolBusy)
+async def worker_pool_busy_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": exc.pool.busy_detail},
+        headers={"Retry-After": str(exc.pool.retry_after)},
+    )
+
+@app.exception_handler(uploads.UploadTooLarge)
+async def upload_too_large_handler(request, exc):
+    return JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, content={"detail": str(exc)})
+
+@app.exception_handler(uploads.InvalidUpload)
+async def invalid_upload_handler(request, exc):
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": str(exc)})
+
+# The upload endpoints read their body themselves, so describe it for the API docs.
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
+
+board_store = BoardStore()
+blob_store = BlobStore()
+board_backend = create_board_backend(board_store)
+board_registry = BoardRegistry(board_backend)
+REGISTRY.register(metrics.BoardCollector(board_registry))
+metrics.instrument_engine(models.async_engine.sync_engine)
+sampling_profiler = profiler.SamplingProfiler(Config.PROFILER_INTERVAL)
+
+@app.on_event("startup")
+async def start_board_compaction():
+    board_store.start_compaction(board_backend.load)
+
+@app.on_event("startup")
+async def start_board_eviction():
+    board_registry.start()
+
+async def reconcile_lesson_counters_forever():
+    while True:
+        await asyncio.sleep(Config.LESSON_COUNTERS_RECONCILE_INTERVAL)
+        try:
+            async with AsyncSessionLocal() as db:
+                if await lesson_counters.reconcile(db):
+                    teachers_cache.clear()
+        except Exception:
+            logger.exception("Error reconciling lesson counters")
+
+@app.on_event("startup")
+async def start_lesson_counters_reconciliation():
+    asyncio.create_task(reconcile_lesson_counters_forever())
+
+async def collect_blobs_forever():
+    while True:
+        await asyncio.sleep(Config.BLOB_GC_INTERVAL)
+        try:
+            async with AsyncSessionLocal() as db:
+                while await blob_store.collect_garbage(db) == Config.BLOB_GC_BATCH:
+                    pass
+        except Exception:
+            logger.exception("Error collecting unreferenced files")
+
+@app.on_event("startup")
+async def start_blob_collection():
+    asyncio.create_task(collect_blobs_forever())
+
+@app.on_event("startup")
+async def start_token_revocations():
+    await auth.revocations.start()
+
+@app.on_event("startup")
+async def create_test_database():
+    if Config.TESTING:
+        async with models.async_engine.begin() as connection:
+            await connection.run_sync(models.Base.metadata.create_all)
+
+@app.on_event("shutdown")
+async def close_board_backend():
+    await board_registry.close()
+    await board_backend.close()
+    await board_store.close()
+    await auth.revocations.close()
+    await models.async_engine.dispose()
+
+AsyncSessionLocal = async_sessionmaker(models.async_engine, expire_on_commit=False)
+
+# Detached User rows by login. Treat them as read-only: sessions do not track them.
+user_cache = TTLCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+
+# The serialized /teachers response and its ETag. Cleared on local changes; the TTL covers other workers.
+teachers_cache = TTLCache(1, Config.TEACHERS_CACHE_TTL)
+teacher_list_adapter = TypeAdapter(List[Teacher])
+REGISTRY.register(metrics.CacheCollector({
+    "users": user_cache,
+    "teachers": teachers_cache,
+    "tokens": auth.token_cache,
+    "file_stats": file_responses.stat_cache,
+}))
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+def read_json_file(path: str):
+    with open(path, "r") as file:
+        return json.load(file)
+
+def encode_cursor(value, row_id: int) -> str:
+    """A keyset cursor: the sort value and id of the last row sent."""
+    value = value.isoformat() if isinstance(value, datetime) else value
+    return base64.urlsafe_b64encode(f"{value}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor: str, parse_value=str):
+    """The (sort value, id) pair of a cursor; `parse_value` turns the value back into the column's type."""
+    try:
+        value, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return parse_value(value), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+class LessonSerializer:
+    """Builds Lesson responses, converting each distinct user to a UserProfile only once per response."""
+
+    def __init__(self):
+        self.profiles: Dict[int, UserProfile] = {}
+
+    def profile(self, user: models.User) -> UserProfile:
+        profile = self.profiles.get(user.id)
+        if profile is None:
+            profile = self.profiles[user.id] = UserProfile.model_validate(user)
+        return profile
+
+    def __call__(self, lesson: models.Class) -> Lesson:
+        return Lesson(
+            id=lesson.id,
+            teacher_id=lesson.teacher_id,
+            teacher=self.profile(lesson.teacher),
+            student_id=lesson.student_id,
+            student=self.profile(lesson.student),
+            date_time=lesson.date_time,
+            duration=lesson.duration,
+            status_id=lesson.status_id,
+        )
+
+def with_participants(query):
+    """Load each lesson's teacher and student in the same query."""
+    return query.options(
+        joinedload(models.Class.teacher, innerjoin=True),
+        joinedload(models.Class.student, innerjoin=True),
+    )
+
+def lessons_query(condition, cursor: Optional[str], date_from: Optional[datetime], date_to: Optional[datetime]):
+    """Lessons with their teacher and student, in keyset order (date_time, id)."""
+    query = with_participants(select(models.Class)).where(condition)
+    if date_from:
+        query = query.where(models.Class.date_time >= date_from)
+    if date_to:
+        query = query.where(models.Class.date_time < date_to)
+    if cursor:
+        query = query.where(tuple_(models.Class.date_time, models.Class.id) > tuple_(*decode_cursor(cursor, datetime.fromisoformat)))
+    return query.order_by(models.Class.date_time.asc(), models.Class.id.asc())
+
+async def stream_lessons(query):
+    # The request's session is closed before a streaming body is sent, so this one brings its own.
+    serialize = LessonSerializer()
+    async with AsyncSessionLocal() as db:
+        result = await db.stream_scalars(query.execution_options(yield_per=Config.LESSONS_STREAM_BATCH))
+        async for lesson in result:
+            yield serialize(lesson).model_dump_json() + "\n"
+
+async def list_lessons(condition, response: Response, db: AsyncSession, limit: int, cursor: Optional[str],
+                       date_from: Optional[datetime], date_to: Optional[datetime], stream: bool):
+    """One page of lessons, with the cursor of the next page in X-Next-Cursor, or all of them as NDJSON."""
+    query = lessons_query(condition, cursor, date_from, date_to)
+    if stream:
+        return StreamingResponse(stream_lessons(query), media_type="application/x-ndjson")
+
+    lessons = (await db.scalars(query.limit(limit + 1))).all()
+    if len(lessons) > limit:
+        lessons = lessons[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(lessons[-1].date_time, lessons[-1].id)
+    serialize = LessonSerializer()
+    return [serialize(lesson) for lesson in lessons]
 
 def create_token_response(username: str, expires_delta: timedelta):
     access_token_expires = datetime.now() + expires_delta
@@ -86,31 +257,29 @@ def create_token_response(username: str, expires_delta: timedelta):
         "expires": access_token_expires
     }
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    try:
-        payload = auth.decode_token(token)
-        if payload is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    payload = auth.verify_token(token)
+    if payload is None or payload.get("type") == "refresh":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-        user = db.query(models.User).filter(models.User.login == username).first()
+    user = user_cache.get(username)
+    if user is None:
+        result = await db.execute(select(models.User).where(models.User.login == username))
+        user = result.scalars().first()
         if user is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        db.expunge(user)
+        user_cache.set(username, user)
 
-        # Token expiration check
-        if datetime.fromtimestamp(payload["exp"]) < datetime.now():
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
-
-        return user
-    except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return user
 
 @app.post("/register", response_model=Token)
-def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    hashed_password = auth.get_password_hash(user.password)
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    hashed_password = await auth.hash_password(user.password)
     db_user = models.User(
         login=user.login,
         password=hashed_password,
@@ -120,8 +289,10 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)):
         role_id=user.role_id
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    user_cache.pop(db_user.login)
+    teachers_cache.clear()
     return create_token_response(user.login, timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES))
 
 @app.post("/update-profile")
@@ -130,58 +301,70 @@ async def update_profile(
     description: str = Form(...),
     photo: str = Form(None),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    current_user.full_name = full_name
-    current_user.description = description
+    user = await db.get(models.User, current_user.id)
+    user.full_name = full_name
+    user.description = description
 
     if photo:
-        current_user.photo = photo
+        user.photo = photo
 
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    user_cache.pop(user.login)
+    teachers_cache.clear()
 
     return {"message": "Profile updated successfully"}
 
 
 @app.post("/token", response_model=Token)
-def login_for_access_token(form_data: UserLogIn, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.login == form_data.login).first()
-    if not user or not auth.verify_password(form_data.password, user.password):
+async def login_for_access_token(form_data: UserLogIn, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(models.User).where(models.User.login == form_data.login))
+    user = result.scalars().first()
+    verified, new_hash = await auth.check_password(form_data.password, user.password) if user else (False, None)
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # The work factor changed since this hash was made.
+        user.password = new_hash
+        await db.commit()
+        user_cache.pop(user.login)
     return create_token_response(user.login, timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES))
 
 @app.post("/refresh", response_model=Token)
-def refresh_access_token(refresh_request: RefreshTokenRequest, db: Session = Depends(get_db)):
-    try:
-        payload = auth.decode_token(refresh_request.refresh_token)
-        if payload is None or payload.get("type") != "refresh":
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-
-        # Token expiration check
-        if datetime.fromtimestamp(payload["exp"]) < datetime.now():
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Refresh token has expired")
-
-        access_token_expires = timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = auth.create_access_token(data={"sub": username}, expires_delta=access_token_expires)
-        expires = datetime.now() + access_token_expires
-        return {
-            "access_token": access_token,
-            "refresh_token": refresh_request.refresh_token,  # Return the same refresh token
-            "token_type": "bearer",
-            "expires": expires
-        }
-    except JWTError:
+async def refresh_access_token(refresh_request: RefreshTokenRequest):
+    payload = auth.verify_token(refresh_request.refresh_token)
+    if payload is None or payload.get("type") != "refresh":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+    username = payload.get("sub")
+    if username is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
+    # Refresh tokens are single use: each refresh returns a new one, and a replayed copy is refused.
+    if not await auth.revoke_token(refresh_request.refresh_token, payload):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Refresh token has already been used")
+
+    return create_token_response(username, timedelta(minutes=Config.ACCESS_TOKEN_EXPIRE_MINUTES))
+
+@app.post("/logout")
+async def logout(logout_request: Optional[RefreshTokenRequest] = None, token: str = Depends(oauth2_scheme)):
+    payload = auth.verify_token(token)
+    if payload is None or payload.get("type") == "refresh":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    await auth.revoke_token(token, payload)
+
+    if logout_request is not None:
+        refresh_payload = auth.verify_token(logout_request.refresh_token)
+        if refresh_payload is not None and refresh_payload.get("sub") == payload.get("sub"):
+            await auth.revoke_token(logout_request.refresh_token, refresh_payload)
+
+    return {"message": "Logged out successfully"}
+
 
 @app.get("/me", response_model=UserProfile)
 def read_users_me(current_user: models.User = Depends(get_current_user)):
@@ -196,79 +379,133 @@ def read_users_me(current_user: models.User = Depends(get_current_user)):
     )
 
 @app.websocket("/ws/{board_id}")
-async def websocket_endpoint(websocket: WebSocket, board_id: int):
-    if board_id not in boards:
-        boards[board_id] = Board()
-    board = boards[board_id]
-    await board.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, board_id: int, since: Optional[int] = None,
+                             page: Optional[int] = None, window: int = 0):
+    board = await board_registry.acquire(board_id)
+    try:
+        await serve_board_connection(board, websocket, since, page_window(page, window))
+    finally:
+        board_registry.release(board_id)
+
+async def serve_board_connection(board: Board, websocket: WebSocket, since: Optional[int], pages: Pages):
+    connection = await board.connect(websocket, since, pages)
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await connection.receive()
+            metrics.WS_MESSAGES_RECEIVED.inc()
             action = data.get('type')
             block_data = data.get('data')
-            if action in ['add_block', 'move_block', 'resize_block', 'update_content', 'update_page_number'] and block_data:
+            if action in ['move_block', 'resize_block'] and block_data:
                 try:
-                    block = Block(**block_data)
-                    await board.receive_block_update(block)
+                    await board.schedule_block_update(action, block_data)
                 except Exception as e:
-                    print(f"Validation error: {e}")
+                    logger.warning("Validation error: %s", e, extra={"board_id": board.board_id, "action": action})
+            elif action in ['add_block', 'update_content', 'update_page_number'] and block_data:
+                try:
+                    await board.receive_block_update(action, block_data)
+                except Exception as e:
+                    logger.warning("Validation error: %s", e, extra={"board_id": board.board_id, "action": action})
             elif action == 'delete_block' and block_data:
                 try:
                     block_id = block_data['id']
                     await board.delete_block(block_id)
                 except Exception as e:
-                    print(f"Error deleting block: {e}")
+                    logger.warning("Error deleting block: %s", e, extra={"board_id": board.board_id})
+            elif action in ['sync', 'subscribe', 'fetch_page']:
+                try:
+                    await serve_board_request(board, websocket, action, data)
+                except ValueError as e:
+                    logger.warning("Invalid message: %s", e, extra={"board_id": board.board_id, "action": action})
     except WebSocketDisconnect:
         board.disconnect(websocket)
-    except Exception as e:
-        print(f"Error: {e}")
+    except Exception:
+        logger.exception("Error in board connection", extra={"board_id": board.board_id})
         board.disconnect(websocket)
 
+def message_int(data: dict, key: str, default: Optional[int] = None) -> Optional[int]:
+    value = data.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{key} must be an integer")
+    return int(value)
+
+async def serve_board_request(board: Board, websocket: WebSocket, action: str, data: dict):
+    """Answer a client asking for board state; a bad field raises ValueError before anything is sent."""
+    if action == 'sync':
+        await board.send_changes_since(websocket, message_int(data, 'since', 0))
+    elif action == 'subscribe':
+        page = message_int(data, 'page')
+        board.subscribe(websocket, page_window(page, message_int(data, 'window', 0)))
+    else:
+        page = message_int(data, 'page')
+        if page is not None:
+            board.send_page(websocket, page)
+
+@app.get("/boards/metrics")
+async def read_boards_metrics():
+    return board_registry.stats()
+
+# Runs on the event loop, so the collectors never see the boards change half way.
+@app.get("/metrics")
+async def read_metrics():
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/debug/profile", response_class=PlainTextResponse)
+async def profile_event_loop(
+    seconds: float = Query(10, gt=0, le=Config.PROFILER_MAX_SECONDS),
+    current_user: models.User = Depends(get_current_user)
+):
+    if not Config.PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if current_user.login not in Config.PROFILER_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to profile this server")
+    try:
+        return PlainTextResponse(await sampling_profiler.profile(seconds))
+    except profiler.ProfilerBusy:
+        raise HTTPException(status_code=409, detail="A profile is already being taken")
+
+@app.get("/boards/{board_id}/metrics")
+def read_board_metrics(board_id: int):
+    board = board_registry.get(board_id)
+    if not board:
+        raise HTTPException(status_code=404, detail="Lesson board not found")
+    return board.stats()
+
 @app.get("/teachers", response_model=List[Teacher])
-def read_teachers(db: Session = Depends(get_db)):
-    subquery_lessons = db.query(
-        models.Class.teacher_id.label('teacher_id'),
-        func.count(models.Class.id).label('lessons_count')
-    ).filter(
-        models.Class.status_id == 3
-    ).group_by(
-        models.Class.teacher_id
-    ).subquery()
-
-    teachers = db.query(
-        models.User.id,
-        models.User.full_name,
-        models.User.description,
-        models.User.photo,
-        models.User.registration_date,
-        subquery_lessons.c.lessons_count
-    ).join(
-        subquery_lessons, models.User.id == subquery_lessons.c.teacher_id, isouter=True
-    ).filter(
-        models.User.role_id == 2
-    ).all()
-
-    result = [
-        {
-            'id': teacher.id,
-            'full_name': teacher.full_name,
-            'description': teacher.description,
-            'photo': teacher.photo,
-            'registration_date': teacher.registration_date,
-            'lessons_amount': teacher.lessons_count if teacher.lessons_count else 0,
-        }
-        for teacher in teachers
-    ]
-
-    return result
+async def read_teachers(request: Request, db: AsyncSession = Depends(get_db)):
+    catalog = teachers_cache.get("catalog")
+    if catalog is None:
+        teachers = (await db.execute(select(models.User).where(models.User.role_id == 2))).scalars().all()
+        body = teacher_list_adapter.dump_json([
+            Teacher(
+                id=teacher.id,
+                full_name=teacher.full_name,
+                description=teacher.description,
+                photo=teacher.photo,
+                registration_date=teacher.registration_date,
+                lessons_amount=teacher.lessons_amount,
+            )
+            for teacher in teachers
+        ])
+        catalog = (f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+        teachers_cache.set("catalog", catalog)
+
+    etag, body = catalog
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and file_responses.etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.post("/lessons/", response_model=int)
-def create_lesson(lesson: LessonCreate, db: Session = Depends(get_db)):
-    teacher = db.get(models.User, lesson.teacher_id)
-    student = db.get(models.User, lesson.student_id)
+async def create_lesson(lesson: LessonCreate, db: AsyncSession = Depends(get_db)):
+    found = (await db.scalars(
+        select(models.User.id).where(models.User.id.in_((lesson.teacher_id, lesson.student_id)))
+    )).all()
 
-    if not teacher or not student:
+    if {lesson.teacher_id, lesson.student_id} - set(found):
         raise HTTPException(status_code=404, detail="Teacher or student not found")
 
     new_lesson = models.Class(
@@ -280,197 +517,289 @@ def create_lesson(lesson: LessonCreate, db: Session = Depends(get_db)):
     )
 
     db.add(new_lesson)
-    db.commit()
-    db.refresh(new_lesson)
+    if await lesson_counters.track_status_change(db, new_lesson.teacher_id, None, new_lesson.status_id):
+        teachers_cache.clear()
+    await db.commit()
+    await db.refresh(new_lesson)
 
     return new_lesson.id
 
-@app.get("/lessons/user/{user_id}", response_model=List[Lesson])
-def read_lessons(user_id: int, db: Session = Depends(get_db)):
-    lessons_query = db.query(
-        models.Class
-    ).filter(
-        or_(models.Class.teacher_id == user_id, models.Class.student_id == user_id)
-    ).order_by(
-        models.Class.date_time.asc()
-    )
-
-    lessons = lessons_query.all()
+@app.post("/lessons/bulk", response_model=List[int])
+async def create_lessons_bulk(batch: LessonBatch, db: AsyncSession = Depends(get_db)):
+    """Schedule a batch of lessons and weekly rules all at once, or nothing if any lesson overlaps another."""
+    # Counted before expanding, so an oversized batch costs nothing to refuse.
+    if len(batch.lessons) + sum(rule.weeks for rule in batch.rules) > Config.LESSONS_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {Config.LESSONS_BULK_MAX} lessons per request")
+    lessons = scheduling.expand_batch(batch)
+    if not lessons:
+        return []
 
-    user_ids = {lesson.teacher_id for lesson in lessons}.union({lesson.student_id for lesson in lessons})
-    user_roles = db.query(models.User).filter(models.User.id.in_(user_ids)).all()
+    user_ids = scheduling.participants(lessons)
+    missing = set(user_ids) - set(await scheduling.lock_participants(db, user_ids))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Users not found: {sorted(missing)}")
 
-    user_map = {user.id: user for user in user_roles}
+    conflicts = await scheduling.find_conflicts(db, lessons, user_ids)
+    if conflicts:
+        raise HTTPException(status_code=409, detail=[conflict.model_dump(mode="json") for conflict in conflicts])
 
-    result = [
-        {
-            'id': lesson.id,
-            'teacher_id': lesson.teacher_id,
-            'teacher': UserProfile.model_validate(user_map[lesson.teacher_id]),
-            'student_id': lesson.student_id,
-            'student': UserProfile.model_validate(user_map[lesson.student_id]),
-            'date_time': lesson.date_time,
-            'duration': lesson.duration,
-            'status_id': lesson.status_id,
-        }
-        for lesson in lessons
-    ]
+    ids = await scheduling.insert_lessons(db, lessons)
+    if await lesson_counters.track_new_lessons(db, lessons):
+        teachers_cache.clear()
+    await db.commit()
+    return ids
 
-    return result
+@app.get("/lessons/user/{user_id}", response_model=List[Lesson])
+async def read_lessons(
+    user_id: int,
+    response: Response,
+    limit: int = Query(Config.LESSONS_PAGE_SIZE, ge=1, le=Config.LESSONS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    date_from: Optional[LessonTime] = None,
+    date_to: Optional[LessonTime] = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_db)
+):
+    condition = or_(models.Class.teacher_id == user_id, models.Class.student_id == user_id)
+    return await list_lessons(condition, response, db, limit, cursor, date_from, date_to, stream)
 
 @app.put("/lessons/{lesson_id}/status", response_model=Lesson)
-def update_lesson_status(lesson_id: int, status_update: LessonUpdateStatus, db: Session = Depends(get_db)):
-    lesson = db.get(models.Class, lesson_id)
+async def update_lesson_status(lesson_id: int, status_update: LessonUpdateStatus, db: AsyncSession = Depends(get_db)):
+    lesson = (await db.scalars(
+        with_participants(select(models.Class)).where(models.Class.id == lesson_id).with_for_update(of=models.Class)
+    )).first()
 
     if not lesson:
         raise HTTPException(status_code=404, detail="Lesson not found")
 
+    old_status = lesson.status_id
     lesson.status_id = status_update.status_id
-    db.commit()
-    db.refresh(lesson)
+    if await lesson_counters.track_status_change(db, lesson.teacher_id, old_status, lesson.status_id):
+        teachers_cache.clear()
+    await db.commit()
 
-    teacher = db.get(models.User, lesson.teacher_id)
-    student = db.get(models.User, lesson.student_id)
-
-    return Lesson(
-        id=lesson.id,
-        teacher_id=lesson.teacher_id,
-        teacher=UserProfile.model_validate(teacher),
-        student_id=lesson.student_id,
-        student=UserProfile.model_validate(student),
-        date_time=lesson.date_time,
-        duration=lesson.duration,
-        status_id=lesson.status_id,
-    )
+    return LessonSerializer()(lesson)
 
 @app.get("/lessons/status/{status_id}", response_model=List[Lesson])
-def get_lessons_by_status(status_id: int, db: Session = Depends(get_db)):
-    lessons_query = db.query(models.Class).filter(models.Class.status_id == status_id).order_by(models.Class.date_time.asc())
-
-    lessons = lessons_query.all()
-
-    user_ids = {lesson.teacher_id for lesson in lessons}.union({lesson.student_id for lesson in lessons})
-    user_roles = db.query(models.User).filter(models.User.id.in_(user_ids)).all()
-    user_map = {user.id: user for user in user_roles}
-
-    result = [
-        {
-            'id': lesson.id,
-            'teacher_id': lesson.teacher_id,
-            'teacher': UserProfile.model_validate(user_map[lesson.teacher_id]),
-            'student_id': lesson.student_id,
-            'student': UserProfile.model_validate(user_map[lesson.student_id]),
-            'date_time': lesson.date_time,
-            'duration': lesson.duration,
-            'status_id': lesson.status_id,
-        }
-        for lesson in lessons
-    ]
-
-    return result
+async def get_lessons_by_status(
+    status_id: int,
+    response: Response,
+    limit: int = Query(Config.LESSONS_PAGE_SIZE, ge=1, le=Config.LESSONS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    date_from: Optional[LessonTime] = None,
+    date_to: Optional[LessonTime] = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_db)
+):
+    condition = models.Class.status_id == status_id
+    return await list_lessons(condition, response, db, limit, cursor, date_from, date_to, stream)
 
 @app.post("/save-lesson/{lesson_id}")
-async def save_lesson(lesson_id: int, db: Session = Depends(get_db)):
-    board = boards.get(lesson_id)
-    if not board:
+async def save_lesson(lesson_id: int, db: AsyncSession = Depends(get_db)):
+    revision, blocks = await board_backend.load(lesson_id)
+    if not revision:
         raise HTTPException(status_code=404, detail="Lesson board not found")
 
     # Update the lesson status to 3 (ended)
-    lesson = db.get(models.Class, lesson_id)
+    lesson = await db.get(models.Class, lesson_id, with_for_update=True)
     if not lesson:
         raise HTTPException(status_code=404, detail="Lesson not found")
+    old_status = lesson.status_id
     lesson.status_id = 3
-    db.commit()
-    db.refresh(lesson)
-
-    # Ensure the directory exists
-    os.makedirs(Config.BOARD_SAVE_DIR, exist_ok=True)
+    if await lesson_counters.track_status_change(db, lesson.teacher_id, old_status, lesson.status_id):
+        teachers_cache.clear()
+    await db.commit()
+    await db.refresh(lesson)
 
     # Save the lesson board
-    lesson_board = db.query(models.LessonBoard).filter(models.LessonBoard.id == lesson_id).first()
+    lesson_board = await db.get(models.LessonBoard, lesson_id)
     if not lesson_board:
         lesson_board = models.LessonBoard(id=lesson_id, title=f"Lesson {datetime.now()}", link=f"{lesson_id}_{uuid.uuid4()}")
         db.add(lesson_board)
-        db.commit()
-        db.refresh(lesson_board)
+        await db.commit()
+        await db.refresh(lesson_board)
 
-    state_file_path = os.path.join(Config.BOARD_SAVE_DIR, f"{lesson_board.link}.json")
-    with open(state_file_path, "w") as state_file:
-        json.dump([block.model_dump() for block in board.blocks.values()], state_file)
+    await board_store.snapshot(lesson_id, revision, blocks)
+    await board_registry.unload_idle(lesson_id)
 
     return JSONResponse(content={"message": "Lesson status updated to 3 and state saved successfully"})
 
 @app.get("/load-lesson/{lesson_id}")
-async def load_lesson(lesson_id: int, db: Session = Depends(get_db)):
-    lesson_board = db.query(models.LessonBoard).filter(models.LessonBoard.id == lesson_id).first()
+async def load_lesson(lesson_id: int, page: Optional[int] = None, window: int = 0, db: AsyncSession = Depends(get_db)):
+    lesson_board = await db.get(models.LessonBoard, lesson_id)
     if not lesson_board:
         raise HTTPException(status_code=404, detail="Lesson board not found")
 
-    state_file_path = os.path.join(Config.BOARD_SAVE_DIR, f"{lesson_board.link}.json")
-    if not os.path.isfile(state_file_path):
-        raise HTTPException(status_code=404, detail="Lesson state not found")
-
-    with open(state_file_path, "r") as state_file:
-        blocks_data = json.load(state_file)
-
-    board = boards.get(lesson_id)
-    if not board:
-        board = Board()
-        boards[lesson_id] = board
-
-    board.blocks = {block_data['id']: Block(**block_data) for block_data in blocks_data}
-    await board.send_update_blocks()
+    restored = await board_store.load(lesson_id)
+    if restored:
+        blocks_data = list(restored[1].values())
+    else:
+        # Boards saved before the patch log existed are a single JSON file named after the link.
+        state_file_path = os.path.join(Config.BOARD_SAVE_DIR, f"{lesson_board.link}.json")
+        if not os.path.isfile(state_file_path):
+            raise HTTPException(status_code=404, detail="Lesson state not found")
+        blocks_data = await asyncio.to_thread(read_json_file, state_file_path)
+
+    blocks = [Block(**block_data).model_dump() for block_data in blocks_data]
+    await board_backend.replace(lesson_id, blocks)
+    # Connected clients reload the board; otherwise it is loaded from the store on the next connect.
+    await board_registry.unload_idle(lesson_id)
+
+    pages = page_window(page, window)
+    if pages is not None:
+        # The whole board is restored, but only the requested pages are sent back.
+        blocks_data = [data for data, block in zip(blocks_data, blocks) if pages[0] <= block["pageNumber"] <= pages[1]]
 
     return JSONResponse(content={"message": "Lesson state loaded successfully", "blocks": blocks_data})
 
 
-@app.post("/upload-profile-photo/")
-async def upload_profile_photo(file: UploadFile = File(...)):
+def profile_photo_filename(filename: str) -> str:
     valid_extensions = {"jpg", "jpeg", "png", "gif"}
-    filename = file.filename
     file_extension = filename.split(".")[-1].lower()
 
     if file_extension not in valid_extensions:
-        raise HTTPException(status_code=400, detail="Invalid file extension")
-    new_filename = f"{uuid.uuid4()}.{file_extension}"
-    file_path = os.path.join(Config.IMAGE_UPLOAD_DIR, new_filename)
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+        raise uploads.InvalidUpload("Invalid file extension")
+    return f"{uuid.uuid4()}.{file_extension}"
 
-    return JSONResponse(content={"filename": new_filename})
+@app.post("/upload-profile-photo/", openapi_extra=UPLOAD_REQUEST_BODY)
+async def upload_profile_photo(request: Request):
+    upload = await uploads.receive_file(request, profile_photo_filename, Config.PHOTO_MAX_SIZE)
+    file_path = os.path.join(Config.IMAGE_UPLOAD_DIR, upload.filename)
+    try:
+        await photos.photo_processor.run(photos.strip_metadata, upload.path)
+        await upload.move_to(file_path)
+    finally:
+        await upload.discard()
+    # The resized variants are made in the background; a request for one that is not ready yet waits for it.
+    photos.photo_processor.make_variants(file_path, upload.filename)
+
+    return JSONResponse(content={"filename": upload.filename})
+
+async def serve_photo_variant(request: Request, filename: str, file_path: str, size: int, cache_control: str) -> Optional[Response]:
+    """The smallest variant at least `size` pixels wide and high (or the largest one), as WebP if the client takes it."""
+    variant_size = next((variant for variant in Config.PHOTO_SIZES if variant >= size), Config.PHOTO_SIZES[-1])
+    extension = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+    variant_path = photos.variant_path(filename, variant_size, extension)
+    response = await file_responses.serve_file(request, variant_path, cache_control=cache_control)
+    if response is None and await file_responses.stat_file(file_path) is not None:
+        try:
+            # Shielded: a client that goes away should not cancel the work for everyone else.
+            await asyncio.shield(photos.photo_processor.make_variants(file_path, filename))
+        except uploads.InvalidUpload:
+            # Not an image Pillow can read (e.g. uploaded before photos were checked): send it as it is.
+            return None
+        response = await file_responses.serve_file(request, variant_path, cache_control=cache_control)
+    if response is not None:
+        response.headers["Vary"] = "Accept"
+    return response
 
 @app.get("/profile-photo/{filename}")
-async def get_profile_photo(filename: str):
+async def get_profile_photo(
+    filename: str,
+    request: Request,
+    size: Optional[int] = Query(None, ge=1, description="Longest side in pixels; served from the nearest pre-made size")
+):
+    # Uploaded photos get a fresh uuid name, so only the placeholder can ever change.
+    cache_control = Config.PHOTO_CACHE_CONTROL
     if filename == "null":
         filename = "null.png"
+        cache_control = Config.FILE_CACHE_CONTROL
     file_path = os.path.join(Config.IMAGE_UPLOAD_DIR, filename)
-    if not os.path.isfile(file_path):
+    response = None
+    if size is not None:
+        response = await serve_photo_variant(request, filename, file_path, size, cache_control)
+    if response is None:
+        response = await file_responses.serve_file(request, file_path, cache_control=cache_control)
+    if response is None:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path)
-
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...), current_user: models.User = Depends(get_current_user)):
-    teacher_folder = Path(os.path.join(Config.FILES_UPLOAD_DIR, str(current_user.id)))
-    teacher_folder.mkdir(parents=True, exist_ok=True)
-    file_path = Path(os.path.join(teacher_folder, file.filename))
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
-
-    return {"filename": file.filename}
-
-@app.get("/my-files", response_model=List[str])
-async def list_my_files(current_user: models.User = Depends(get_current_user)):
-    teacher_folder = Path(os.path.join(Config.FILES_UPLOAD_DIR, str(current_user.id)))
-    if not teacher_folder.exists():
-        return []
+    return response
+
+@app.post("/upload", openapi_extra=UPLOAD_REQUEST_BODY)
+async def upload_file(
+    request: Request,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    stored = await blob_store.stored_bytes(db, current_user.id)
+    # Don't keep a pooled connection in a transaction while the body streams in.
+    await db.commit()
+    upload = await uploads.receive_file(
+        request, uploads.safe_filename, Config.UPLOAD_MAX_SIZE, user_id=current_user.id, stored=stored
+    )
+    try:
+        await blob_store.add_file(db, current_user.id, upload)
+    finally:
+        await upload.discard()
 
-    files = [f.name for f in teacher_folder.iterdir() if f.is_file()]
-    return files
+    return {"filename": upload.filename, "size": upload.size, "sha256": upload.sha256}
+
+FILE_SORT_COLUMNS = {
+    "name": models.TeacherFile.name,
+    "size": models.TeacherFile.size,
+    "uploaded_at": models.TeacherFile.uploaded_at,
+}
+
+FILE_SORT_TYPES = {"name": str, "size": int, "uploaded_at": datetime.fromisoformat}
+
+def teacher_file_to_dict(teacher_file: models.TeacherFile):
+    return {
+        'file_name': teacher_file.name,
+        'file_type': teacher_file.mime_type,
+        'size': teacher_file.size,
+        'sha256': teacher_file.blob_sha256,
+        'uploaded_at': teacher_file.uploaded_at,
+    }
+
+@app.get("/my-files", response_model=List[TeacherFiles])
+async def list_my_files(
+    response: Response,
+    limit: int = Query(Config.FILES_PAGE_SIZE, ge=1, le=Config.FILES_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort: str = Query("name", pattern="^-?(name|size|uploaded_at)$", description="Prefix with - for descending order"),
+    prefix: Optional[str] = Query(None, description="Only files whose name starts with this"),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """One page of the current user's files, with the cursor of the next page in X-Next-Cursor."""
+    descending = sort.startswith("-")
+    sort = sort.lstrip("-")
+    keyset = tuple_(FILE_SORT_COLUMNS[sort], models.TeacherFile.id)
+
+    query = select(models.TeacherFile).where(models.TeacherFile.teacher_id == current_user.id)
+    if prefix:
+        query = query.where(models.TeacherFile.name.startswith(prefix, autoescape=True))
+    if cursor:
+        after = tuple_(*decode_cursor(cursor, FILE_SORT_TYPES[sort]))
+        query = query.where(keyset < after if descending else keyset > after)
+    order = (FILE_SORT_COLUMNS[sort], models.TeacherFile.id)
+    query = query.order_by(*(column.desc() if descending else column.asc() for column in order))
+
+    files = (await db.scalars(query.limit(limit + 1))).all()
+    if len(files) > limit:
+        files = files[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(getattr(files[-1], sort), files[-1].id)
+    return [teacher_file_to_dict(teacher_file) for teacher_file in files]
+
+@app.delete("/my-files/{file_name}")
+async def delete_my_file(file_name: str, current_user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if not await blob_store.remove_file(db, current_user.id, file_name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    await db.commit()
+    return {"message": "File deleted successfully"}
 
 @app.get("/files/{teacher_id}/{file_name}", response_class=FileResponse)
-async def read_file(teacher_id: int, file_name: str):
-    file_path = Path(os.path.join(Config.FILES_UPLOAD_DIR, str(teacher_id), file_name))
-    if not file_path.exists():
+async def read_file(teacher_id: int, file_name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    teacher_file = await blob_store.file(db, teacher_id, file_name)
+    response = None
+    if teacher_file is not None:
+        # Blobs are named by their content, which makes the hash a strong ETag.
+        response = await file_responses.serve_file(
+            request,
+            blob_store.path(teacher_file.blob_sha256),
+            media_type=teacher_file.mime_type,
+            etag=f'"{teacher_file.blob_sha256}"',
+        )
+    if response is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
 
-    return FileResponse(file_path)
+    return response
@@ -0,0 +1,149 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to answer an HTTP request.", ["method", "route", "status"]
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "Database statements run while answering an HTTP request.", ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+REQUEST_QUERY_TIME = Histogram(
+    "http_request_db_seconds", "Time spent in database statements while answering an HTTP request.", ["route"]
+)
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Time of each database statement.", buckets=FAST_BUCKETS)
+POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_seconds", "Time to get a connection from the pool.", buckets=FAST_BUCKETS)
+PASSWORD_HASH_DURATION = Histogram("password_hash_seconds", "bcrypt time per hash or check.", ["operation"])
+WS_MESSAGES_RECEIVED = Counter("whiteboard_messages_received", "Messages received from whiteboard clients.")
+WS_MESSAGES_SENT = Counter("whiteboard_messages_sent", "Messages sent to whiteboard clients.")
+WS_BYTES_SENT = Counter("whiteboard_sent_bytes", "Bytes sent to whiteboard clients.")
+WS_BROADCAST_DURATION = Histogram(
+    "whiteboard_broadcast_seconds", "Time to queue a board update for all of its connections.", buckets=FAST_BUCKETS
+)
+WS_CONNECTIONS_DROPPED = Counter(
+    "whiteboard_connections_dropped", "Whiteboard connections closed by the server.", ["reason"]
+)
+
+
+class RequestQueries:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Statements run on behalf of the current HTTP request, if any.
+request_queries: ContextVar[Optional[RequestQueries]] = ContextVar("request_queries", default=None)
+
+
+def instrument_engine(engine):
+    """Time every statement run through `engine` (a sync Engine, e.g. `async_engine.sync_engine`)."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.metrics_started
+        QUERY_DURATION.observe(elapsed)
+        queries = request_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += elapsed
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """The asyncio connection pool, recording how long each checkout waits."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    """Records latency and database use of each HTTP request, labelled by route template.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        queries = RequestQueries()
+        token = request_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            request_queries.reset(token)
+            # FastAPI puts the matched route in the scope; unmatched paths share one label.
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            REQUEST_DURATION.labels(scope["method"], path, str(status_code)).observe(elapsed)
+            REQUEST_QUERIES.labels(path).observe(queries.count)
+            REQUEST_QUERY_TIME.labels(path).observe(queries.seconds)
+
+
+class BoardCollector:
+    """Whiteboard gauges read from the board registry at scrape time."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def collect(self):
+        boards = list(self.registry.boards.items())
+        active = GaugeMetricFamily("whiteboard_boards", "Boards held in memory.")
+        active.add_metric([], len(boards))
+        blocks = GaugeMetricFamily("whiteboard_blocks", "Blocks held in memory across all boards.")
+        blocks.add_metric([], sum(len(board.blocks) for _, board in boards))
+        connections = GaugeMetricFamily("whiteboard_board_connections", "Open websockets per board.", labels=["board"])
+        for board_id, board in boards:
+            connections.add_metric([str(board_id)], len(board.connections))
+        yield active
+        yield blocks
+        yield connections
+
+
+class CacheCollector:
+    """Hits, misses and size of the in-process caches, read from their counters at scrape time."""
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Lookups answered from the cache.", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Lookups that found nothing or an expired entry.", labels=["cache"])
+        size = GaugeMetricFamily("cache_entries", "Entries held in the cache.", labels=["cache"])
+        for name, cache in self.caches.items():
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            size.add_metric([name], len(cache.entries))
+        yield hits
+        yield misses
+        yield size
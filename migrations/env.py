@@ -0,0 +1,30 @@
+from alembic import context
+from sqlalchemy import create_engine
+from config import Config
+import models
+
+# The URL can be overridden, e.g. by scripts/check_query_plans.py; otherwise it comes from config.py.
+url = context.config.get_main_option("sqlalchemy.url")
+if not url:
+    url = Config.TEST_DATABASE_URI if Config.TESTING else Config.SQLALCHEMY_DATABASE_URI
+
+
+def run_migrations_offline():
+    context.configure(url=url, target_metadata=models.Base.metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=models.Base.metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,63 @@
+"""Initial schema
+
+Databases created before migrations existed already have these tables:
+mark them with `alembic stamp 0001` instead of upgrading.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-16
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'roles',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(255), nullable=False),
+    )
+    op.create_table(
+        'statuses',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(255), nullable=False),
+    )
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('password', sa.String(255), nullable=False),
+        sa.Column('login', sa.String(255), nullable=False, unique=True),
+        sa.Column('full_name', sa.String(255), nullable=False),
+        sa.Column('photo', sa.Text),
+        sa.Column('registration_date', sa.TIMESTAMP),
+        sa.Column('description', sa.Text),
+        sa.Column('role_id', sa.Integer, sa.ForeignKey('roles.id'), nullable=False),
+    )
+    op.create_table(
+        'classes',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('teacher_id', sa.Integer, sa.ForeignKey('users.id')),
+        sa.Column('student_id', sa.Integer, sa.ForeignKey('users.id')),
+        sa.Column('date_time', sa.TIMESTAMP, nullable=False),
+        sa.Column('duration', sa.Integer, nullable=False),
+        sa.Column('status_id', sa.Integer, sa.ForeignKey('statuses.id')),
+    )
+    op.create_table(
+        'lesson_boards',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('title', sa.String(255), nullable=False),
+        sa.Column('link', sa.Text, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('lesson_boards')
+    op.drop_table('classes')
+    op.drop_table('users')
+    op.drop_table('statuses')
+    op.drop_table('roles')
@@ -0,0 +1,47 @@
+"""Indexes for the hot query shapes
+
+- classes.teacher_id OR classes.student_id, ordered by date_time, id (/lessons/user/{id})
+- classes.status_id ordered by date_time, id (/lessons/status/{id})
+- completed (status 3) lessons counted per teacher (/teachers)
+- users.role_id (/teachers)
+
+lesson_boards.id is the primary key and already has its index.
+
+On PostgreSQL the indexes are built CONCURRENTLY so that classes stays writable meanwhile.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-16
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_users_role_id', 'users', ['role_id'], None),
+    ('ix_classes_teacher_id_date_time', 'classes', ['teacher_id', 'date_time', 'id'], None),
+    ('ix_classes_student_id_date_time', 'classes', ['student_id', 'date_time', 'id'], None),
+    ('ix_classes_status_id_date_time', 'classes', ['status_id', 'date_time', 'id'], None),
+    ('ix_classes_completed_teacher_id', 'classes', ['teacher_id', 'id'], 'status_id = 3'),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                sqlite_where=sa.text(where) if where else None,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,30 @@
+"""Materialized count of completed lessons per teacher
+
+users.lessons_amount replaces counting classes with status 3 on every /teachers request.
+It is kept up to date by the endpoints that change a lesson's status and recounted
+periodically (scripts/reconcile_lesson_counters.py does the same on demand).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-16
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('lessons_amount', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(
+        "UPDATE users SET lessons_amount = ("
+        "SELECT count(*) FROM classes WHERE classes.teacher_id = users.id AND classes.status_id = 3)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch:
+        batch.drop_column('lessons_amount')
@@ -0,0 +1,46 @@
+"""Content-addressed storage for teacher files
+
+Files are stored once per content under BLOB_DIR and listed per teacher in teacher_files.
+Existing files in FILES_UPLOAD_DIR are moved over by scripts/migrate_files_to_blobs.py.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-16
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'blobs',
+        sa.Column('sha256', sa.String(64), primary_key=True),
+        sa.Column('size', sa.BigInteger, nullable=False),
+        sa.Column('ref_count', sa.Integer, nullable=False),
+        sa.Column('released_at', sa.TIMESTAMP),
+    )
+    op.create_index(
+        'ix_blobs_unreferenced', 'blobs', ['released_at'],
+        postgresql_where=sa.text('ref_count = 0'), sqlite_where=sa.text('ref_count = 0'),
+    )
+    op.create_table(
+        'teacher_files',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('teacher_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('name', sa.String(255), nullable=False),
+        sa.Column('blob_sha256', sa.String(64), sa.ForeignKey('blobs.sha256'), nullable=False),
+        sa.UniqueConstraint('teacher_id', 'name', name='uq_teacher_files_teacher_id_name'),
+    )
+    op.create_index('ix_teacher_files_blob_sha256', 'teacher_files', ['blob_sha256'])
+
+
+def downgrade():
+    op.drop_index('ix_teacher_files_blob_sha256', table_name='teacher_files')
+    op.drop_table('teacher_files')
+    op.drop_index('ix_blobs_unreferenced', table_name='blobs')
+    op.drop_table('blobs')
@@ -0,0 +1,60 @@
+"""Size, MIME type and upload time in the teacher file index
+
+Lets /my-files list, sort and search files without touching the blobs or the disk.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-16
+"""
+import mimetypes
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('teacher_files') as batch:
+        batch.add_column(sa.Column('size', sa.BigInteger))
+        batch.add_column(sa.Column('mime_type', sa.String(255)))
+        batch.add_column(sa.Column('uploaded_at', sa.TIMESTAMP))
+
+    connection = op.get_bind()
+    connection.execute(sa.text(
+        "UPDATE teacher_files SET size = (SELECT size FROM blobs WHERE blobs.sha256 = teacher_files.blob_sha256)"
+    ))
+    # MIME types come from the file names, the same way uploads get theirs.
+    teacher_files = sa.table('teacher_files', sa.column('id'), sa.column('name'), sa.column('mime_type'), sa.column('uploaded_at'))
+    now = datetime.now()
+    for file_id, name in connection.execute(sa.select(teacher_files.c.id, teacher_files.c.name)).all():
+        connection.execute(
+            teacher_files.update().where(teacher_files.c.id == file_id).values(
+                mime_type=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                uploaded_at=now,
+            )
+        )
+
+    with op.batch_alter_table('teacher_files') as batch:
+        batch.alter_column('size', existing_type=sa.BigInteger, nullable=False)
+        batch.alter_column('mime_type', existing_type=sa.String(255), nullable=False)
+        batch.alter_column('uploaded_at', existing_type=sa.TIMESTAMP, nullable=False)
+    op.create_index('ix_teacher_files_teacher_id_size', 'teacher_files', ['teacher_id', 'size', 'id'])
+    op.create_index('ix_teacher_files_teacher_id_uploaded_at', 'teacher_files', ['teacher_id', 'uploaded_at', 'id'])
+    op.create_index(
+        'ix_teacher_files_teacher_id_name_pattern', 'teacher_files', ['teacher_id', 'name'],
+        postgresql_ops={'name': 'varchar_pattern_ops'},
+    )
+
+
+def downgrade():
+    op.drop_index('ix_teacher_files_teacher_id_name_pattern', table_name='teacher_files')
+    op.drop_index('ix_teacher_files_teacher_id_uploaded_at', table_name='teacher_files')
+    op.drop_index('ix_teacher_files_teacher_id_size', table_name='teacher_files')
+    with op.batch_alter_table('teacher_files') as batch:
+        batch.drop_column('uploaded_at')
+        batch.drop_column('mime_type')
+        batch.drop_column('size')
@@ -1,11 +1,27 @@
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Boolean, Text, TIMESTAMP, DECIMAL, TIME, CheckConstraint
+from sqlalchemy import create_engine, BigInteger, Column, Integer, String, UniqueConstraint, ForeignKey, Boolean, Text, TIMESTAMP, DECIMAL, TIME, CheckConstraint, Index, text
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine
 from config import Config
+from metrics import TimedQueuePool
 
 Base = declarative_base()
-engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
+
+if Config.TESTING:
+    engine = create_engine(Config.TEST_DATABASE_URI)
+    async_engine = create_async_engine(Config.TEST_ASYNC_DATABASE_URI)
+else:
+    engine = create_engine(Config.SQLALCHEMY_DATABASE_URI)
+    async_engine = create_async_engine(
+        Config.ASYNC_SQLALCHEMY_DATABASE_URI,
+        pool_size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_MAX_OVERFLOW,
+        pool_timeout=Config.DB_POOL_TIMEOUT,
+        pool_recycle=Config.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        poolclass=TimedQueuePool,
+    )
 
 
 
@@ -25,6 +41,12 @@ class User(Base):
     description = Column(Text)
     role_id = Column(Integer, ForeignKey('roles.id'), nullable=False)
     role = relationship("Role", backref=backref("users", cascade="all, delete-orphan"))
+    # Completed lessons taught, maintained on status changes (see lesson_counters.py).
+    lessons_amount = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index('ix_users_role_id', 'role_id'),
+    )
 
 class Status(Base):
     __tablename__ = 'statuses'
@@ -40,9 +62,56 @@ class Class(Base):
     duration = Column(Integer, nullable=False)
     status_id = Column(Integer, ForeignKey('statuses.id'))
     status = relationship("Status", backref=backref("classes", cascade="all, delete-orphan"))
+    # Not loaded implicitly (that fails under asyncio): queries ask for them with joinedload().
+    teacher = relationship("User", foreign_keys=[teacher_id], lazy="raise")
+    student = relationship("User", foreign_keys=[student_id], lazy="raise")
+
+    # Matched to the lesson listings (keyset order date_time, id) and the completed-lessons count per teacher.
+    __table_args__ = (
+        Index('ix_classes_teacher_id_date_time', 'teacher_id', 'date_time', 'id'),
+        Index('ix_classes_student_id_date_time', 'student_id', 'date_time', 'id'),
+        Index('ix_classes_status_id_date_time', 'status_id', 'date_time', 'id'),
+        Index('ix_classes_completed_teacher_id', 'teacher_id', 'id',
+              postgresql_where=text('status_id = 3'), sqlite_where=text('status_id = 3')),
+    )
 
 class LessonBoard(Base):
     __tablename__ = 'lesson_boards'
     id = Column(Integer, primary_key=True)
     title = Column(String(255), nullable=False)
     link = Column(Text, nullable=False)
+
+class Blob(Base):
+    """A stored file, named by the SHA-256 of its content and shared by every upload of that content."""
+    __tablename__ = 'blobs'
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    # When the last reference went away; garbage collection waits BLOB_GC_GRACE after it.
+    released_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        Index('ix_blobs_unreferenced', 'released_at', postgresql_where=text('ref_count = 0'), sqlite_where=text('ref_count = 0')),
+    )
+
+class TeacherFile(Base):
+    __tablename__ = 'teacher_files'
+    id = Column(Integer, primary_key=True)
+    teacher_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    name = Column(String(255), nullable=False)
+    blob_sha256 = Column(String(64), ForeignKey('blobs.sha256'), nullable=False)
+    blob = relationship("Blob", lazy="raise")
+    # Copied from the upload so /my-files never has to touch the blobs or the disk.
+    size = Column(BigInteger, nullable=False)
+    mime_type = Column(String(255), nullable=False)
+    uploaded_at = Column(TIMESTAMP, nullable=False, default=datetime.now)
+
+    # One per /my-files sort order; the pattern index serves prefix search on PostgreSQL.
+    __table_args__ = (
+        UniqueConstraint('teacher_id', 'name', name='uq_teacher_files_teacher_id_name'),
+        Index('ix_teacher_files_blob_sha256', 'blob_sha256'),
+        Index('ix_teacher_files_teacher_id_size', 'teacher_id', 'size', 'id'),
+        Index('ix_teacher_files_teacher_id_uploaded_at', 'teacher_id', 'uploaded_at', 'id'),
+        Index('ix_teacher_files_teacher_id_name_pattern', 'teacher_id', 'name',
+              postgresql_ops={'name': 'varchar_pattern_ops'}),
+    )
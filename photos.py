@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+from typing import Dict
+from PIL import Image, ImageOps, UnidentifiedImageError
+from config import Config
+from uploads import InvalidUpload
+from workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+SOURCE_FORMATS = ("JPEG", "PNG", "GIF")
+VARIANT_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+def variant_path(filename: str, size: int, extension: str) -> str:
+    return os.path.join(Config.PHOTO_VARIANT_DIR, f"{filename.rsplit('.', 1)[0]}-{size}.{extension}")
+
+
+def open_photo(path: str) -> Image.Image:
+    try:
+        image = Image.open(path)
+    except (UnidentifiedImageError, OSError):
+        raise InvalidUpload("Not a valid image")
+    if image.format not in SOURCE_FORMATS:
+        image.close()
+        raise InvalidUpload("Not a valid image")
+    if image.width * image.height > Config.PHOTO_MAX_PIXELS:
+        image.close()
+        raise InvalidUpload("Image is too large")
+    return image
+
+
+def strip_metadata(path: str):
+    """Rewrite an uploaded photo without EXIF (camera, location, ...), turned upright first.
+
+    GIFs carry no EXIF and are only checked, which keeps animations intact.
+    """
+    with open_photo(path) as image:
+        if image.format == "GIF":
+            return
+        try:
+            upright = ImageOps.exif_transpose(image)
+            # Pillow only writes EXIF when asked to, so saving drops it.
+            upright.save(path + ".clean", format=image.format, quality=Config.PHOTO_ORIGINAL_QUALITY)
+        except OSError:
+            raise InvalidUpload("Not a valid image")
+    os.replace(path + ".clean", path)
+
+
+def make_variants(path: str, filename: str):
+    os.makedirs(Config.PHOTO_VARIANT_DIR, exist_ok=True)
+    with open_photo(path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        for size in Config.PHOTO_SIZES:
+            variant = image.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            for extension, format in VARIANT_FORMATS.items():
+                output = variant
+                if format == "JPEG" and variant.mode == "RGBA":
+                    output = Image.new("RGB", variant.size, (255, 255, 255))
+                    output.paste(variant, mask=variant.getchannel("A"))
+                target = variant_path(filename, size, extension)
+                output.save(target + ".tmp", format=format, quality=Config.PHOTO_VARIANT_QUALITY)
+                os.replace(target + ".tmp", target)
+
+
+class PhotoProcessor(WorkerPool):
+    """Runs Pillow on a bounded thread pool (it releases the GIL while decoding and resizing)."""
+
+    def __init__(self, workers: int, queue_size: int):
+        super().__init__(
+            "photo-processor",
+            workers,
+            queue_size,
+            retry_after=Config.PHOTO_RETRY_AFTER,
+            busy_detail="Too many photos are being processed, please retry",
+        )
+        self.jobs: Dict[str, asyncio.Task] = {}
+
+    def make_variants(self, path: str, filename: str) -> asyncio.Task:
+        """Start producing the variants of a photo unless that is already under way."""
+        task = self.jobs.get(filename)
+        if task is None:
+            task = self.jobs[filename] = asyncio.create_task(self.run(make_variants, path, filename))
+            task.add_done_callback(lambda task: self.finish(filename, task))
+        return task
+
+    def finish(self, filename: str, task: asyncio.Task):
+        self.jobs.pop(filename, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error making photo variants", extra={"photo": filename}, exc_info=task.exception())
+
+
+photo_processor = PhotoProcessor(Config.PHOTO_WORKERS, Config.PHOTO_QUEUE_SIZE)
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+
+
+class ProfilerBusy(Exception):
+    """A profile is already being taken."""
+
+
+def collapse(frame: FrameType) -> str:
+    """The stack as `outer;...;inner`, each function as `name (file:first line)`."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples one thread's stack every `interval` seconds from another thread. Costs nothing while idle.
+
+    The result uses the collapsed stack format that flame graph tools (flamegraph.pl, speedscope)
+    read: one line per distinct stack with the number of samples that caught it.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.running = False
+
+    def sample(self, thread_id: int, seconds: float) -> Counter:
+        samples = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples[collapse(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        return samples
+
+    async def profile(self, seconds: float) -> str:
+        """Sample the event loop's thread for `seconds` while it goes on serving requests."""
+        if self.running:
+            raise ProfilerBusy()
+        self.running = True
+        try:
+            samples = await asyncio.to_thread(self.sample, threading.get_ident(), seconds)
+        finally:
+            self.running = False
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
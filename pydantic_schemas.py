@@ -1,6 +1,15 @@
-from pydantic import BaseModel, EmailStr, Field
-from datetime import datetime
-from typing import Optional
+from pydantic import AfterValidator, BaseModel, EmailStr, Field
+from datetime import datetime, timezone
+from typing import Annotated, List, Optional
+from config import Config
+
+def naive_utc(value: datetime) -> datetime:
+    # Lesson times are stored without a zone, as UTC; aware input would not compare with them.
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+LessonTime = Annotated[datetime, AfterValidator(naive_utc)]
 
 class UserBase(BaseModel):
     login: EmailStr
@@ -91,13 +100,37 @@ class Lesson(BaseModel):
 class LessonCreate(BaseModel):
     teacher_id: int
     student_id: int
-    date_time: datetime
-    duration: int
+    date_time: LessonTime
+    duration: int = Field(gt=0, le=Config.LESSON_MAX_DURATION)
     status_id: int
 
+class LessonRule(BaseModel):
+    """A weekly slot: the first lesson at `date_time`, then one every week for `weeks` weeks in total."""
+    teacher_id: int
+    student_id: int
+    date_time: LessonTime
+    duration: int = Field(gt=0, le=Config.LESSON_MAX_DURATION)
+    weeks: int = Field(ge=1, le=Config.LESSONS_BULK_MAX)
+    status_id: int = 1
+
+class LessonBatch(BaseModel):
+    lessons: List[LessonCreate] = []
+    rules: List[LessonRule] = []
+
+class LessonConflict(BaseModel):
+    """`index` is the position of the new lesson in the expanded batch: `lessons` first, then each rule week by week."""
+    index: int
+    user_id: int
+    date_time: datetime
+    conflicts_with_lesson: Optional[int] = None
+    conflicts_with_index: Optional[int] = None
+
 class LessonUpdateStatus(BaseModel):
     status_id: int
 
-class TeacherFiles():
+class TeacherFiles(BaseModel):
     file_name: str
     file_type: str
+    size: int
+    sha256: str
+    uploaded_at: datetime
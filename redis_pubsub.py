@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+# Called with the channel and data of each message, both as bytes.
+MessageHandler = Callable[[bytes, bytes], Awaitable[None]]
+
+
+class RedisSubscriber:
+    """One pub/sub connection, read by a single listener task started with the first subscription.
+
+    Connection errors are logged and retried every second. An error in `handle` is logged and the
+    listener goes on with the next message.
+    """
+
+    def __init__(self, client: redis.Redis, handle: MessageHandler, name: str):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.handle = handle
+        self.name = name
+        self.listener: Optional[asyncio.Task] = None
+
+    async def subscribe(self, channel: str):
+        await self.pubsub.subscribe(channel)
+        if self.listener is None:
+            self.listener = asyncio.create_task(self.listen())
+
+    async def unsubscribe(self, channel: str):
+        await self.pubsub.unsubscribe(channel)
+
+    async def listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("%s pub/sub error: %s", self.name, e)
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            try:
+                await self.handle(message["channel"], message["data"])
+            except Exception:
+                logger.exception("Error handling %s message", self.name)
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        await self.pubsub.aclose()
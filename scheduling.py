@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import Config
+from pydantic_schemas import LessonBatch, LessonConflict, LessonCreate
+import models
+
+# start, end, existing lesson id or None, index in the batch or None
+Slot = Tuple[datetime, datetime, Optional[int], Optional[int]]
+
+
+def expand_batch(batch: LessonBatch) -> List[LessonCreate]:
+    lessons = list(batch.lessons)
+    for rule in batch.rules:
+        lessons.extend(
+            LessonCreate(
+                teacher_id=rule.teacher_id,
+                student_id=rule.student_id,
+                date_time=rule.date_time + timedelta(weeks=week),
+                duration=rule.duration,
+                status_id=rule.status_id,
+            )
+            for week in range(rule.weeks)
+        )
+    return lessons
+
+
+def participants(lessons: Sequence[LessonCreate]) -> List[int]:
+    return sorted({lesson.teacher_id for lesson in lessons} | {lesson.student_id for lesson in lessons})
+
+
+async def lock_participants(db: AsyncSession, user_ids: List[int]) -> List[int]:
+    """Lock the users in id order and return those that exist.
+
+    Concurrent schedules touching the same teacher or student wait for each other here, so the
+    overlap check below cannot race with another insert on PostgreSQL.
+    """
+    return (await db.scalars(
+        select(models.User.id).where(models.User.id.in_(user_ids)).order_by(models.User.id).with_for_update()
+    )).all()
+
+
+async def find_conflicts(db: AsyncSession, lessons: Sequence[LessonCreate], user_ids: List[int]) -> List[LessonConflict]:
+    """Overlaps of the new lessons with each other and with stored lessons, per teacher and student.
+
+    A stored lesson can only overlap if it starts within LESSON_MAX_DURATION before the earliest new
+    lesson, which keeps the lookup a range scan on the (teacher_id|student_id, date_time) indexes.
+    """
+    slots: Dict[int, List[Slot]] = {}
+    for index, lesson in enumerate(lessons):
+        end = lesson.date_time + timedelta(minutes=lesson.duration)
+        for user_id in {lesson.teacher_id, lesson.student_id}:
+            slots.setdefault(user_id, []).append((lesson.date_time, end, None, index))
+
+    start = min(lesson.date_time for lesson in lessons) - timedelta(minutes=Config.LESSON_MAX_DURATION)
+    end = max(lesson.date_time + timedelta(minutes=lesson.duration) for lesson in lessons)
+    existing = await db.execute(
+        select(models.Class.id, models.Class.teacher_id, models.Class.student_id, models.Class.date_time, models.Class.duration)
+        .where(
+            or_(models.Class.teacher_id.in_(user_ids), models.Class.student_id.in_(user_ids)),
+            models.Class.date_time >= start,
+            models.Class.date_time < end,
+        )
+    )
+    for lesson_id, teacher_id, student_id, date_time, duration in existing:
+        slot = (date_time, date_time + timedelta(minutes=duration), lesson_id, None)
+        for user_id in {teacher_id, student_id} & slots.keys():
+            slots[user_id].append(slot)
+
+    conflicts = []
+    for user_id, user_slots in slots.items():
+        user_slots.sort(key=lambda slot: slot[0])
+        latest = None  # the slot seen so far that ends last
+        for slot in user_slots:
+            if latest is not None and slot[0] < latest[1] and (slot[3] is not None or latest[3] is not None):
+                new, other = (slot, latest) if slot[3] is not None else (latest, slot)
+                conflicts.append(LessonConflict(
+                    index=new[3],
+                    user_id=user_id,
+                    date_time=new[0],
+                    conflicts_with_lesson=other[2],
+                    conflicts_with_index=other[3],
+                ))
+            if latest is None or slot[1] > latest[1]:
+                latest = slot
+    return sorted(conflicts, key=lambda conflict: (conflict.index, conflict.user_id))
+
+
+async def insert_lessons(db: AsyncSession, lessons: Sequence[LessonCreate]) -> List[int]:
+    """Insert with one multi-row INSERT ... RETURNING; ids come back in the order of `lessons`."""
+    result = await db.scalars(
+        insert(models.Class).returning(models.Class.id, sort_by_parameter_order=True),
+        [lesson.model_dump() for lesson in lessons],
+    )
+    return result.all()
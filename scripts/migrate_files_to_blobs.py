@@ -0,0 +1,82 @@
+"""Move teacher files from FILES_UPLOAD_DIR/<teacher_id>/<name> into the blob store.
+
+    alembic upgrade head
+    python scripts/migrate_files_to_blobs.py
+
+Each file is hashed, stored once under BLOB_DIR and indexed in teacher_files, then removed from its
+old place. Safe to run again after an interruption: files already indexed are just removed.
+"""
+import hashlib
+import mimetypes
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+from blob_store import BlobStore
+from config import Config
+import models
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(Config.UPLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def migrate_file(db: Session, blob_store: BlobStore, teacher_id: int, name: str, path: str) -> bool:
+    indexed = db.scalar(select(models.TeacherFile.id).where(
+        models.TeacherFile.teacher_id == teacher_id, models.TeacherFile.name == name
+    ))
+    if indexed is None:
+        sha256 = file_sha256(path)
+        stat = os.stat(path)
+        updated = db.execute(
+            update(models.Blob).where(models.Blob.sha256 == sha256).values(ref_count=models.Blob.ref_count + 1)
+        ).rowcount
+        if not updated:
+            db.execute(insert(models.Blob).values(sha256=sha256, size=stat.st_size, ref_count=1))
+        blob_path = blob_store.path(sha256)
+        if not os.path.isfile(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(path, blob_path)
+        db.add(models.TeacherFile(
+            teacher_id=teacher_id,
+            name=name,
+            blob_sha256=sha256,
+            size=stat.st_size,
+            mime_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+            uploaded_at=datetime.fromtimestamp(stat.st_mtime),
+        ))
+        db.commit()
+    if os.path.exists(path):
+        os.remove(path)
+    return indexed is None
+
+
+def main():
+    blob_store = BlobStore()
+    migrated = skipped = 0
+    with Session(models.engine) as db:
+        for folder in sorted(os.listdir(Config.FILES_UPLOAD_DIR)) if os.path.isdir(Config.FILES_UPLOAD_DIR) else []:
+            if not folder.isdigit():
+                continue
+            directory = os.path.join(Config.FILES_UPLOAD_DIR, folder)
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if not os.path.isfile(path):
+                    continue
+                if migrate_file(db, blob_store, int(folder), name, path):
+                    migrated += 1
+                else:
+                    skipped += 1
+    print(f"Moved {migrated} file(s) into {Config.BLOB_DIR}, {skipped} were already there")
+
+
+if __name__ == "__main__":
+    main()
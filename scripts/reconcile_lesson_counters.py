@@ -0,0 +1,26 @@
+"""Recount users.lessons_amount from the classes table and report how many counters had drifted.
+
+    python scripts/reconcile_lesson_counters.py
+
+The running API does the same every LESSON_COUNTERS_RECONCILE_INTERVAL seconds.
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy.ext.asyncio import AsyncSession
+import lesson_counters
+import models
+
+
+async def main():
+    async with AsyncSession(models.async_engine) as db:
+        fixed = await lesson_counters.reconcile(db)
+    await models.async_engine.dispose()
+    print(f"Reconciled lessons_amount for {fixed} user(s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
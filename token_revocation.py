@@ -0,0 +1,83 @@
+import time
+from typing import Dict, Optional
+import redis.asyncio as redis
+from config import Config
+from redis_pubsub import RedisSubscriber
+
+
+class RevocationList:
+    """Ids (`jti`) of tokens that must no longer be accepted, each kept until the token expires anyway.
+
+    `is_revoked` is checked on every authenticated request, so it only ever looks at this worker's
+    memory. `revoke` returns False if the token was already revoked, which makes it safe to use for
+    one-time refresh tokens.
+    """
+
+    def __init__(self):
+        self.revoked: Dict[str, float] = {}
+        self.next_purge = 0.0
+
+    def is_revoked(self, token_id: str) -> bool:
+        return token_id in self.revoked
+
+    def remember(self, token_id: str, exp: float) -> bool:
+        now = time.time()
+        if now >= self.next_purge:
+            self.revoked = {token: until for token, until in self.revoked.items() if until > now}
+            self.next_purge = now + Config.TOKEN_REVOCATION_PURGE_INTERVAL
+        if token_id in self.revoked:
+            return False
+        self.revoked[token_id] = exp
+        return True
+
+    async def revoke(self, token_id: str, exp: float) -> bool:
+        return self.remember(token_id, exp)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class RedisRevocationList(RevocationList):
+    """Revocations seen by every worker, not only the one that revoked the token.
+
+    Revoked ids live in a sorted set scored by expiry, which a starting worker loads, and are
+    announced over pub/sub so running workers add them to their own memory within milliseconds.
+    """
+
+    key = "revoked_tokens"
+
+    def __init__(self, url: str = Config.REDIS_URL, client: Optional[redis.Redis] = None):
+        super().__init__()
+        self.client = client if client is not None else redis.from_url(url)
+        self.subscriber = RedisSubscriber(self.client, self.receive, "Token revocation")
+
+    async def revoke(self, token_id: str, exp: float) -> bool:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(self.key, "-inf", time.time())
+            pipe.zadd(self.key, {token_id: exp}, nx=True)
+            pipe.publish(self.key, f"{exp}:{token_id}")
+            _, added, _ = await pipe.execute()
+        self.remember(token_id, exp)
+        return bool(added)
+
+    async def start(self):
+        await self.subscriber.subscribe(self.key)
+        for token_id, exp in await self.client.zrangebyscore(self.key, time.time(), "+inf", withscores=True):
+            self.remember(token_id.decode(), exp)
+
+    async def receive(self, channel: bytes, data: bytes):
+        exp, token_id = data.decode().split(":", 1)
+        self.remember(token_id, float(exp))
+
+    async def close(self):
+        await self.subscriber.close()
+        await self.client.aclose()
+
+
+def create_revocation_list() -> RevocationList:
+    if Config.TOKEN_REVOCATION_BACKEND == "redis":
+        return RedisRevocationList()
+    return RevocationList()
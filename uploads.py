@@ -0,0 +1,231 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Callable, Dict, List, Optional
+from fastapi import Request
+from multipart.multipart import MultipartParser, parse_options_header
+from config import Config
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+class UploadedFile:
+    """A complete upload still sitting in UPLOAD_TMP_DIR, with its bytes reserved against the quotas.
+
+    Either `move_to` its destination or `discard` it; discarding after a move does nothing.
+    """
+
+    def __init__(self, filename: str, path: str, size: int, sha256: str, user_id: Optional[int]):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.user_id = user_id
+        self.done = False
+
+    async def move_to(self, path: str):
+        try:
+            replaced = await asyncio.to_thread(replace_file, self.path, path)
+        except BaseException:
+            await self.discard()
+            raise
+        self.done = True
+        upload_quota.settle(self.user_id, self.size, self.size - replaced)
+
+    async def discard(self):
+        if not self.done:
+            self.done = True
+            await asyncio.to_thread(remove_file, self.path)
+            upload_quota.settle(self.user_id, self.size, 0)
+
+
+def directory_size(directory: str) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def safe_filename(filename: str) -> str:
+    """The client's file name without any directory part."""
+    name = os.path.basename(filename.replace("\\", "/")).strip()
+    if name in ("", ".", ".."):
+        raise InvalidUpload("Invalid file name")
+    return name
+
+
+class UploadQuota:
+    """Bytes on disk in total, and bytes each user is uploading right now.
+
+    The total is measured from disk the first time it is needed, then kept up to date by the uploads
+    of this worker; other workers' uploads are only seen after a restart, so keep some headroom.
+    What a user already stores is passed in by the caller, who knows how it is counted.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, int] = {}
+        self.total: Optional[int] = None
+
+    async def load(self):
+        if self.total is None:
+            sizes = await asyncio.gather(*(
+                asyncio.to_thread(directory_size, directory)
+                for directory in (Config.BLOB_DIR, Config.IMAGE_UPLOAD_DIR)
+            ))
+            if self.total is None:
+                self.total = sum(sizes)
+
+    def reserve(self, user_id: Optional[int], stored: int, size: int):
+        if self.total + size > Config.UPLOADS_TOTAL_QUOTA:
+            raise UploadTooLarge("Storage quota exceeded")
+        if user_id is not None:
+            if stored + self.users.get(user_id, 0) + size > Config.USER_FILES_QUOTA:
+                raise UploadTooLarge("Your storage quota is exceeded")
+            self.users[user_id] = self.users.get(user_id, 0) + size
+        self.total += size
+
+    def settle(self, user_id: Optional[int], reserved: int, kept: int):
+        """End a reservation of `reserved` bytes of which `kept` stay on disk."""
+        if user_id is not None:
+            left = self.users.pop(user_id, 0) - reserved
+            if left:
+                self.users[user_id] = left
+        self.total -= reserved - kept
+
+    def freed(self, size: int):
+        if self.total is not None:
+            self.total -= size
+
+
+upload_quota = UploadQuota()
+
+
+async def receive_file(request: Request, name_file: Callable[[str], str], max_size: int,
+                       user_id: Optional[int] = None, stored: int = 0, field: str = "file") -> UploadedFile:
+    """Stream the `field` file of a multipart request into a temporary file.
+
+    The body is parsed as it arrives and written in UPLOAD_CHUNK_SIZE pieces on a worker thread, so
+    neither memory nor the event loop depend on the upload size. `name_file` maps the client's file
+    name to the stored one (or raises InvalidUpload) before any data is written. The size limit and
+    the quotas (`stored` is what the user already has) are checked chunk by chunk. The caller then
+    moves the complete file into place, which is an atomic rename.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size + Config.UPLOAD_FORM_OVERHEAD:
+        raise UploadTooLarge(f"File is larger than {max_size} bytes")
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    if b"boundary" not in params:
+        raise InvalidUpload("Expected a multipart/form-data body")
+
+    await upload_quota.load()
+    part = {"headers": [], "name": b"", "value": b"", "file": False}
+    events: List[tuple] = []
+
+    def on_part_begin():
+        part.update(headers=[], name=b"", value=b"", file=False)
+
+    def on_header_field(data: bytes, start: int, end: int):
+        part["name"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"].append((part["name"].lower(), part["value"]))
+        part["name"], part["value"] = b"", b""
+
+    def on_headers_finished():
+        disposition = dict(part["headers"]).get(b"content-disposition", b"")
+        _, options = parse_options_header(disposition)
+        if options.get(b"name", b"").decode("latin-1") == field and b"filename" in options:
+            part["file"] = True
+            events.append(("begin", options[b"filename"].decode("utf-8", "replace")))
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if part["file"]:
+            events.append(("data", data[start:end]))
+
+    def on_part_end():
+        if part["file"]:
+            events.append(("end", None))
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    os.makedirs(Config.UPLOAD_TMP_DIR, exist_ok=True)
+    temp_path = os.path.join(Config.UPLOAD_TMP_DIR, f"{uuid.uuid4()}.part")
+    target, temp, size, received, reserved = None, None, 0, 0, 0
+    sha256 = hashlib.sha256()
+    buffer = bytearray()
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_size + Config.UPLOAD_FORM_OVERHEAD:
+                raise UploadTooLarge(f"File is larger than {max_size} bytes")
+            parser.write(chunk)
+            for event, value in events:
+                if event == "begin":
+                    if target is not None:
+                        raise InvalidUpload("Only one file can be uploaded at a time")
+                    target = name_file(value)
+                    temp = await asyncio.to_thread(open, temp_path, "wb")
+                elif event == "data":
+                    size += len(value)
+                    if size > max_size:
+                        raise UploadTooLarge(f"File is larger than {max_size} bytes")
+                    upload_quota.reserve(user_id, stored, len(value))
+                    reserved += len(value)
+                    sha256.update(value)
+                    buffer += value
+                if buffer and (event == "end" or len(buffer) >= Config.UPLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(temp.write, bytes(buffer))
+                    buffer.clear()
+            events.clear()
+        parser.finalize()
+        if target is None:
+            raise InvalidUpload(f"No file in the '{field}' field")
+
+        await asyncio.to_thread(temp.close)
+        return UploadedFile(target, temp_path, size, sha256.hexdigest(), user_id)
+    except BaseException:
+        upload_quota.settle(user_id, reserved, 0)
+        if temp is not None:
+            await asyncio.to_thread(temp.close)
+            await asyncio.to_thread(remove_file, temp_path)
+        raise
+
+
+def replace_file(source: str, path: str) -> int:
+    """Move `source` to `path` atomically. Returns the size of the file it replaced, if any."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        replaced = os.path.getsize(path)
+    except OSError:
+        replaced = 0
+    os.replace(source, path)
+    return replaced
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,126 @@
+import json
+from typing import Dict, Optional, Tuple
+import msgpack
+from fastapi import WebSocket
+
+# Compact msgpack layout: message keys are shortened, message types and block fields become
+# small integers, and full blocks are sent as arrays in FIELDS order.
+FIELDS = ("id", "x", "y", "width", "height", "content", "contentType", "contentUrl", "pageNumber")
+TYPES = (
+    "update_blocks", "patch_block", "delete_block", "patches", "sync",
+    "add_block", "move_block", "resize_block", "update_content", "update_page_number",
+    "subscribe", "fetch_page", "page_blocks",
+)
+KEYS = {"type": "t", "revision": "r", "id": "i", "changes": "c", "blocks": "b", "patches": "p", "since": "s", "data": "d"}
+
+FIELD_INDEX = {field: index for index, field in enumerate(FIELDS)}
+TYPE_INDEX = {name: index for index, name in enumerate(TYPES)}
+KEY_NAMES = {short: key for key, short in KEYS.items()}
+
+
+class Frame:
+    """An outgoing message plus its encodings, so a broadcast is serialized once per codec."""
+
+    __slots__ = ("message", "encoded")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self.encoded: Dict[str, object] = {}
+
+    def encode(self, codec):
+        payload = self.encoded.get(codec.name)
+        if payload is None:
+            payload = self.encoded[codec.name] = codec.encode(self.message)
+        return payload
+
+
+class JsonCodec:
+    name = "whiteboard.json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        return json.dumps(message, separators=(",", ":"))
+
+    def decode(self, data: str) -> dict:
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "whiteboard.msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(self.compact(message))
+
+    def decode(self, data: bytes) -> dict:
+        return self.expand(msgpack.unpackb(data, strict_map_key=False))
+
+    def compact(self, message: dict) -> dict:
+        compact = {}
+        for key, value in message.items():
+            if key == "type":
+                value = TYPE_INDEX.get(value, value)
+            elif key in ("changes", "data"):
+                value = {FIELD_INDEX.get(field, field): item for field, item in value.items()}
+            elif key == "blocks":
+                value = [[block[field] for field in FIELDS] for block in value]
+            elif key == "patches":
+                value = [self.compact(patch) for patch in value]
+            compact[KEYS.get(key, key)] = value
+        return compact
+
+    def expand(self, compact: dict) -> dict:
+        message = {}
+        for short, value in compact.items():
+            key = KEY_NAMES.get(short, short)
+            if key == "type" and isinstance(value, int):
+                value = TYPES[value]
+            elif key in ("changes", "data"):
+                value = {FIELDS[field] if isinstance(field, int) else field: item for field, item in value.items()}
+            elif key == "blocks":
+                value = [dict(zip(FIELDS, block)) for block in value]
+            elif key == "patches":
+                value = [self.expand(patch) for patch in value]
+            message[key] = value
+        return message
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+
+
+class Wire:
+    """The encoding a single websocket negotiated on connect.
+
+    Compression is left to the transport: uvicorn negotiates permessage-deflate (RFC 7692) with
+    clients that offer it.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    @property
+    def subprotocol(self) -> str:
+        return self.codec.name
+
+    async def send(self, websocket: WebSocket, frame: Frame) -> int:
+        payload = frame.encode(self.codec)
+        if self.codec.binary:
+            await websocket.send_bytes(payload)
+        else:
+            await websocket.send_text(payload)
+        return len(payload)
+
+    async def receive(self, websocket: WebSocket) -> dict:
+        if self.codec.binary:
+            return self.codec.decode(await websocket.receive_bytes())
+        return self.codec.decode(await websocket.receive_text())
+
+
+def negotiate(websocket: WebSocket) -> Tuple[Optional[str], Wire]:
+    """Pick the first subprotocol offered by the client that we support; plain JSON otherwise."""
+    for offered in websocket.scope.get("subprotocols", []):
+        codec = CODECS.get(offered)
+        if codec is not None:
+            wire = Wire(codec)
+            return wire.subprotocol, wire
+    return None, Wire(CODECS[JsonCodec.name])
@@ -0,0 +1,34 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WorkerPoolBusy(Exception):
+    """A worker pool already has as much work as it accepts."""
+
+    def __init__(self, pool: "WorkerPool"):
+        super().__init__(pool.busy_detail)
+        self.pool = pool
+
+
+class WorkerPool:
+    """Runs blocking calls on a bounded thread pool instead of the event loop.
+
+    At most `workers` calls run at once and `queue_size` more may wait for a thread. Past that, `run`
+    raises WorkerPoolBusy right away, which the API answers with 503, `busy_detail` and `retry_after`.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int, retry_after: int, busy_detail: str):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.capacity = workers + queue_size
+        self.in_flight = 0
+        self.retry_after = retry_after
+        self.busy_detail = busy_detail
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.capacity:
+            raise WorkerPoolBusy(self)
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1